@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+
+"""
+Topology discovery: crawl the network from a set of seed devices,
+following LLDP and CDP neighbour tables.
+
+The crawl is breadth-first. Each device is discovered as usual, then its neighbours are
+queued for discovery one level deeper, using their management address where the neighbour
+table reports one, and their system name otherwise. Devices are only visited once, and the
+crawl stops at the configured depth, device count and address boundaries; neighbours
+beyond those boundaries still appear in the link list, but aren't discovered.
+
+To test against simulated local agents, e.g. several snmpsim instances on 127.0.0.0/8
+addresses, seed the crawl with one of them and set --within 127.0.0.0/8.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# From this package
+from netdescribe.snmp.credentials import CredentialCache
+from netdescribe.snmp.device_discovery import explore_device
+from netdescribe.utils import create_logger, IPInterfaceEncoder
+
+# Included batteries
+import argparse
+from collections import deque, namedtuple
+import concurrent.futures
+import ipaddress
+import json
+
+
+Link = namedtuple('link', [
+    'localDevice',      # Target of the device whose neighbour table reported the link
+    'localPort',        # Port on that device
+    'remoteDevice',     # Target of the neighbour: its management address, or its name
+    'remotePort',       # Port on the neighbour
+    'protocol',         # lldp | cdp
+    ])
+
+
+class TopologyCrawler:
+    "Breadth-first crawl of a network, via LLDP and CDP neighbour tables"
+
+    def __init__(self, logger=None, community='public', port=161, workers=16, max_depth=None,
+                 max_devices=None, within=None, discover=None, credential_cache=None):
+        '''
+        - community: a community string, or a list of candidates to try on each device.
+        - credential_cache: a netdescribe.snmp.credentials.CredentialCache, recording which
+          of the candidate communities worked for each device.
+        - workers: the maximum number of devices being discovered at once.
+        - max_depth: how many hops from the seeds to crawl. None means no limit.
+        - max_devices: stop queueing new devices once this many have been visited.
+        - within: list of networks, e.g. ['10.0.0.0/8']. If supplied, only neighbours whose
+          management address falls in one of them are crawled; neighbours that report
+          no address are not crawled either.
+        - discover: callable(target, logger) returning a device object or False.
+          Defaults to running explore_device with 'community', 'port' and 'credential_cache'.
+        '''
+        self.logger = logger or create_logger()
+        self.community = community
+        self.port = port
+        self.credential_cache = credential_cache
+        self.workers = workers
+        self.max_depth = max_depth
+        self.max_devices = max_devices
+        self.within = [ipaddress.ip_network(net) for net in within] if within else None
+        self.discover = discover or self._explore
+
+    def _explore(self, target, logger):
+        'Default discovery function.'
+        return explore_device(target, logger, community=self.community, port=self.port,
+                              credential_cache=self.credential_cache)
+
+    def _in_bounds(self, address):
+        'Check whether a neighbour may be crawled, according to self.within.'
+        if self.within is None:
+            return True
+        if address is None:
+            return False
+        addr = ipaddress.ip_address(address)
+        return any(addr in net for net in self.within)
+
+    def _crawl_one(self, target):
+        'Discover a single device, and fetch its neighbours.'
+        device = self.discover(target, self.logger)
+        if not device:
+            return (False, [])
+        try:
+            neighbours = device.neighbours()
+        except RuntimeError as err:
+            self.logger.error('Failed to retrieve neighbours of %s: %s', target, err)
+            neighbours = []
+        return (device, neighbours)
+
+    def crawl(self, seeds):
+        '''
+        Crawl the network, starting from a list of hostnames or addresses.
+        Return a dict:
+        - devices: dict of target -> device object, for each device discovered
+        - links: list of Link namedtuples. Each link is reported once,
+          even if both ends report it.
+        - failed: targets on which discovery failed
+        - unvisited: neighbour targets that weren't crawled, because they were
+          out of bounds or beyond the depth or device limits
+        '''
+        devices = {}
+        links = []
+        failed = []
+        unvisited = set()
+        visited = set()     # Targets queued or discovered so far
+        names = {}          # sysName -> target, to spot devices reported under another name
+        seen_links = set()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            inflight = {}   # Future -> (target, depth)
+            queue = deque((seed, 0) for seed in seeds)
+            visited.update(seeds)
+            while queue or inflight:
+                # Keep the pool busy, taking the shallowest devices first.
+                while queue and len(inflight) < self.workers:
+                    (target, depth) = queue.popleft()
+                    inflight[executor.submit(self._crawl_one, target)] = (target, depth)
+                done, _ = concurrent.futures.wait(list(inflight),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    (target, depth) = inflight.pop(future)
+                    try:
+                        (device, neighbours) = future.result()
+                    except Exception as err:    # pylint: disable=broad-except
+                        self.logger.error('Discovery of %s failed: %s', target, err)
+                        (device, neighbours) = (False, [])
+                    if not device:
+                        failed.append(target)
+                        continue
+                    devices[target] = device
+                    if device.system_data and device.system_data.sysName:
+                        names.setdefault(device.system_data.sysName, target)
+                    self.logger.info('Discovered %s at depth %s, with %s neighbours',
+                                     target, depth, len(neighbours))
+                    for neighbour in neighbours:
+                        remote = neighbour.remoteAddress or neighbour.remoteName
+                        # Report the neighbour under the target we already know it by, if any
+                        remote = names.get(neighbour.remoteName, remote)
+                        key = frozenset([(target, neighbour.localPort),
+                                         (remote, neighbour.remotePort)])
+                        if (key, neighbour.protocol) not in seen_links:
+                            seen_links.add((key, neighbour.protocol))
+                            links.append(Link(localDevice=target,
+                                              localPort=neighbour.localPort,
+                                              remoteDevice=remote,
+                                              remotePort=neighbour.remotePort,
+                                              protocol=neighbour.protocol))
+                        if remote in visited:
+                            continue
+                        if ((self.max_depth is not None and depth >= self.max_depth)
+                                or (self.max_devices is not None
+                                    and len(visited) >= self.max_devices)
+                                or not self._in_bounds(neighbour.remoteAddress)):
+                            unvisited.add(remote)
+                            continue
+                        visited.add(remote)
+                        unvisited.discard(remote)
+                        queue.append((remote, depth + 1))
+        return {'devices': devices,
+                'links': links,
+                'failed': sorted(failed),
+                'unvisited': sorted(unvisited)}
+
+
+def crawl_to_dict(result):
+    'Convert the output of TopologyCrawler.crawl to a dict, suitable for rendering in JSON.'
+    return {'devices': {target: device.as_dict()
+                        for (target, device) in result['devices'].items()},
+            'links': [link._asdict() for link in result['links']],
+            'failed': result['failed'],
+            'unvisited': result['unvisited']}
+
+
+def main():
+    '''
+    Crawl a network from the command line.
+    '''
+    parser = argparse.ArgumentParser(description='Discover the topology of a network via \
+    LLDP and CDP, starting from one or more seed devices.')
+    parser.add_argument('seeds', type=str, nargs='+',
+                        help='Hostnames or addresses to start from')
+    parser.add_argument('--community', type=str, action='append', default=None,
+                        help='SNMP v2 community string. May be repeated, in which case all the \
+                        candidates are tried at once on each device. Defaults to public.')
+    parser.add_argument('--credential-cache', type=str, dest='credential_cache', default=None,
+                        help='File recording which community works for each host, for use \
+                        with several --community options.')
+    parser.add_argument('--port', type=int, default=161, help='UDP port for SNMP')
+    parser.add_argument('--workers', type=int, default=16,
+                        help='Maximum number of concurrent discoveries')
+    parser.add_argument('--depth', type=int, default=None, dest='max_depth',
+                        help='Maximum number of hops from the seeds')
+    parser.add_argument('--max-devices', type=int, default=None, dest='max_devices',
+                        help='Maximum number of devices to discover')
+    parser.add_argument('--within', type=str, action='append', default=None,
+                        help='Only crawl neighbours within this network. May be repeated.')
+    parser.add_argument('--file', type=str, dest='filepath', default=None,
+                        help='Filepath to write the results to. If this is not specified, \
+                        STDOUT will be used.')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+    if args.debug:
+        logger = create_logger(loglevel="debug")
+    elif args.filepath:
+        logger = create_logger()
+    else:
+        logger = create_logger(loglevel="warning")
+    cache = CredentialCache(args.credential_cache) if args.credential_cache else None
+    crawler = TopologyCrawler(logger=logger,
+                              community=args.community or ['public'],
+                              port=args.port,
+                              workers=args.workers,
+                              max_depth=args.max_depth,
+                              max_devices=args.max_devices,
+                              within=args.within,
+                              credential_cache=cache)
+    output = json.dumps(crawl_to_dict(crawler.crawl(args.seeds)),
+                        indent=4,
+                        sort_keys=True,
+                        cls=IPInterfaceEncoder)
+    if args.filepath:
+        with open(args.filepath, 'w') as outfile:
+            outfile.write(output)
+    else:
+        print(output)
+
+if __name__ == '__main__':
+    main()
@@ -24,10 +24,15 @@ depending on whether the --file parameter is supplied.
 # From this package
 import netdescribe.files
 import netdescribe.stdout
+from netdescribe.profiling import DiscoveryProfiler, memory_tracing
+from netdescribe.snmp import snmp_functions
+from netdescribe.snmp.credentials import CredentialCache
+from netdescribe.snmp.discovery_profiles import PROFILES
 from netdescribe.utils import create_logger
 
 # Included batteries
 import argparse
+import sys
 
 
 def basic_demo():
@@ -43,10 +48,19 @@ def basic_demo():
                         help='The hostname or address to perform discovery on')
     parser.add_argument('--community',
                         type=str,
-                        action='store',
+                        action='append',
                         dest='community',
-                        default='public',
-                        help='SNMP v2 community string')
+                        default=None,
+                        help='SNMP v2 community string. May be repeated, in which case all \
+                        the candidates are tried at once, and the first that works is used. \
+                        Defaults to public.')
+    parser.add_argument('--credential-cache',
+                        type=str,
+                        action='store',
+                        dest='credential_cache',
+                        default=None,
+                        help='File recording which community works for each host, so that \
+                        later runs try it first.')
     parser.add_argument('--file',
                         type=str,
                         action='store',
@@ -54,6 +68,65 @@ def basic_demo():
                         default=None,
                         help='Filepath to write the results to. If this is not specified, \
                         STDOUT will be used.')
+    parser.add_argument('--record',
+                        type=str,
+                        action='store',
+                        dest='record',
+                        default=None,
+                        help='Record all SNMP requests and responses to this file.')
+    parser.add_argument('--replay',
+                        type=str,
+                        action='store',
+                        dest='replay',
+                        default=None,
+                        help='Serve SNMP responses from a file made with --record, \
+                        instead of querying the device.')
+    parser.add_argument('--replay-speed',
+                        type=float,
+                        action='store',
+                        dest='replay_speed',
+                        default=None,
+                        help='With --replay, reproduce the recorded response times, \
+                        divided by this factor. By default, responses are served immediately.')
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Report the time and memory taken by each phase of discovery, \
+                        on STDERR.')
+    parser.add_argument('--profile-output',
+                        type=str,
+                        action='store',
+                        dest='profile_output',
+                        default=None,
+                        help='With --profile, also run cProfile and write its stats to this \
+                        file, in pstats format.')
+    parser.add_argument('--budget',
+                        type=float,
+                        action='store',
+                        dest='budget',
+                        default=None,
+                        help='Maximum number of seconds to spend on the device. When it runs \
+                        out, whatever has been retrieved so far is returned.')
+    parser.add_argument('--table-budget',
+                        type=float,
+                        action='store',
+                        dest='table_budget',
+                        default=None,
+                        help='Maximum number of seconds to spend on each table.')
+    parser.add_argument('--window',
+                        type=int,
+                        action='store',
+                        dest='window',
+                        default=None,
+                        help='Number of table walks to have in flight against the device at \
+                        once. By default, they run one at a time.')
+    parser.add_argument('--discovery-profile',
+                        type=str,
+                        action='store',
+                        dest='discovery_profile',
+                        choices=sorted(PROFILES),
+                        default=None,
+                        help='Retrieve only part of the data from the device, e.g. "names" for \
+                        just its name and the names of its interfaces. Defaults to everything.')
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     args = parser.parse_args()
     # Set debug logging, if requested
@@ -66,12 +139,42 @@ def basic_demo():
     # don't require the user to filter the output to make it useful.
     else:
         logger = create_logger(loglevel="warning")
+    # Record or replay the SNMP traffic, if requested
+    if args.replay:
+        snmp_functions.start_replay(args.replay, speed=args.replay_speed)
+    elif args.record:
+        snmp_functions.start_recording(args.record)
+    community = args.community or ['public']
+    cache = CredentialCache(args.credential_cache) if args.credential_cache else None
+    # Profile the discovery, if requested
+    if args.profile:
+        profiler = DiscoveryProfiler(cprofile=bool(args.profile_output))
+    else:
+        profiler = None
     # Perform SNMP discovery on a device,
     # sending the result to STDOUT or a file, depending on what the user told us.
-    if args.filepath:
-        netdescribe.files.snmp_to_json(args.hostname, args.community, args.filepath, logger)
-    else:
-        netdescribe.stdout.snmp_to_json(args.hostname, args.community, logger)
+    try:
+        with memory_tracing(enabled=bool(profiler)):
+            if args.filepath:
+                netdescribe.files.snmp_to_json(args.hostname, community, args.filepath, logger,
+                                               profiler=profiler, budget=args.budget,
+                                               table_budget=args.table_budget,
+                                               window=args.window, credential_cache=cache,
+                                               discovery_profile=args.discovery_profile)
+            else:
+                netdescribe.stdout.snmp_to_json(args.hostname, community, logger,
+                                                profiler=profiler, budget=args.budget,
+                                                table_budget=args.table_budget,
+                                                window=args.window, credential_cache=cache,
+                                                discovery_profile=args.discovery_profile)
+    finally:
+        snmp_functions.stop_session()
+    # Report on the profiling.
+    # This goes to STDERR, so it doesn't get mixed up with JSON output on STDOUT.
+    if profiler:
+        print(profiler.report(), file=sys.stderr)
+        if args.profile_output:
+            profiler.dump_stats(args.profile_output)
 
 if __name__ == '__main__':
     basic_demo()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+
+"""
+Differential output: report only what has changed on a device since its previous snapshot.
+
+A snapshot is the output of a device's as_dict(). Each snapshot is stored with a digest of
+its contents, so an unchanged device is recognised by comparing digests, without loading
+or walking through the previous snapshot. When something has changed, the change set lists:
+- system fields whose values differ
+- interfaces added, removed or modified, keyed by ifName (or ifIndex, where ifName is empty)
+- addresses added, removed or modified, keyed by interface, protocol and address
+The 'discovery' section of a snapshot is not compared; instead, the change set carries
+its 'complete' flag. When a discovery phase didn't run or complete, the sections it feeds are
+carried over from the previous snapshot, so that items it simply didn't retrieve aren't
+reported as removed, nor dropped from the stored snapshot.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# From this package
+from netdescribe.utils import IPInterfaceEncoder
+
+# Included batteries
+import hashlib
+import json
+import os
+import os.path
+
+
+# Which discovery phases each section of a snapshot depends on: one phase from each tuple
+# must have completed. Addresses come from either ipAddressTable or the older ipAddrTable,
+# and device classes don't all have both phases, so either is enough.
+SECTION_PHASES = {
+    'system': [('identify',)],
+    'interfaces': [('interfaces',)],
+    'addresses': [('interfaces',), ('ip_addresses', 'ip_addrs')],
+    }
+
+
+def normalise(data):
+    '''
+    Return a copy of an as_dict() result containing only JSON types,
+    so that it compares equal to the same snapshot after a round trip through a file.
+    '''
+    return json.loads(json.dumps(data, cls=IPInterfaceEncoder))
+
+def device_digest(data):
+    'Return a SHA-256 hex digest of an as_dict() result, ignoring its discovery metadata.'
+    content = {key: value for (key, value) in data.items() if key != 'discovery'}
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'),
+                           cls=IPInterfaceEncoder)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _interfaces_by_key(data):
+    'Index the interfaces of a snapshot by ifName, falling back to ifIndex.'
+    return {iface.get('ifName') or iface.get('ifIndex'): iface
+            for iface in data.get('interfaces', {}).values()}
+
+def _addresses_by_key(interfaces):
+    'Index the addresses of a set of interfaces by (interface, protocol, address).'
+    result = {}
+    for (name, iface) in interfaces.items():
+        for address in iface.get('addresses', []):
+            result[(name, address.get('protocol'), address.get('address'))] = address
+    return result
+
+def incomplete_sections(data):
+    '''
+    Return the set of sections of an as_dict() result that discovery didn't fill,
+    because a phase they depend on didn't run or didn't complete.
+    A result without discovery metadata is taken to be complete.
+    '''
+    if 'discovery' not in data:
+        return set()
+    phases = data['discovery'].get('phases', {})
+    return {section for (section, requirements) in SECTION_PHASES.items()
+            if not all(any(phases.get(phase) == 'complete' for phase in alternatives)
+                       for alternatives in requirements)}
+
+def carry_over(old, new):
+    '''
+    Return a copy of 'new' in which the sections that its discovery didn't complete are
+    taken from 'old', which may be None. 'new' is returned unchanged if it's complete.
+    The interfaces section includes their addresses, so it's carried over as a whole;
+    when only the addresses are incomplete, each interface keeps its previous addresses.
+    '''
+    incomplete = incomplete_sections(new)
+    if not incomplete or not old:
+        return new
+    result = dict(new)
+    if 'system' in incomplete and 'system' in old:
+        result['system'] = old['system']
+    if 'interfaces' in incomplete:
+        if 'interfaces' in old:
+            result['interfaces'] = old['interfaces']
+    elif 'addresses' in incomplete:
+        old_ifaces = _interfaces_by_key(old)
+        result['interfaces'] = {}
+        for (index, iface) in new.get('interfaces', {}).items():
+            previous = old_ifaces.get(iface.get('ifName') or iface.get('ifIndex'), {})
+            result['interfaces'][index] = dict(iface, addresses=previous.get('addresses', []))
+    return result
+
+def _field_changes(old, new, ignore=()):
+    'Return a dict of field -> {old, new} for the fields that differ between two dicts.'
+    return {field: {'old': old.get(field), 'new': new.get(field)}
+            for field in sorted(set(old) | set(new))
+            if field not in ignore and old.get(field) != new.get(field)}
+
+def diff_devices(old, new):
+    '''
+    Compare two as_dict() results for the same device.
+    'old' may be None, in which case everything in 'new' is reported as added.
+    Return None if they're identical, apart from their discovery metadata.
+    Otherwise, return a change set: a dict containing only the sections that changed,
+    out of 'system', 'interfaces' and 'addresses', along with 'complete'.
+    Sections that the new discovery didn't complete are compared as if unchanged.
+    '''
+    new = carry_over(old, normalise(new))
+    if old is not None and device_digest(old) == device_digest(new):
+        return None
+    old = old or {}
+    changes = {'complete': new.get('discovery', {}).get('complete')}
+    # System fields
+    system = _field_changes(old.get('system', {}), new.get('system', {}))
+    if system:
+        changes['system'] = system
+    # Interfaces
+    (old_ifaces, new_ifaces) = (_interfaces_by_key(old), _interfaces_by_key(new))
+    interfaces = {}
+    added = {name: {field: value for (field, value) in iface.items() if field != 'addresses'}
+             for (name, iface) in new_ifaces.items() if name not in old_ifaces}
+    if added:
+        interfaces['added'] = added
+    removed = sorted(name for name in old_ifaces if name not in new_ifaces)
+    if removed:
+        interfaces['removed'] = removed
+    modified = {}
+    for (name, iface) in new_ifaces.items():
+        if name in old_ifaces:
+            fields = _field_changes(old_ifaces[name], iface, ignore=('addresses',))
+            if fields:
+                modified[name] = fields
+    if modified:
+        interfaces['modified'] = modified
+    if interfaces:
+        changes['interfaces'] = interfaces
+    # Addresses
+    (old_addrs, new_addrs) = (_addresses_by_key(old_ifaces), _addresses_by_key(new_ifaces))
+    addresses = {}
+    added = [dict(address, interface=key[0])
+             for (key, address) in sorted(new_addrs.items()) if key not in old_addrs]
+    if added:
+        addresses['added'] = added
+    removed = [dict(address, interface=key[0])
+               for (key, address) in sorted(old_addrs.items()) if key not in new_addrs]
+    if removed:
+        addresses['removed'] = removed
+    modified = [{'interface': key[0], 'protocol': key[1], 'address': key[2],
+                 'changes': _field_changes(old_addrs[key], address)}
+                for (key, address) in sorted(new_addrs.items())
+                if key in old_addrs and old_addrs[key] != address]
+    if modified:
+        addresses['modified'] = modified
+    if addresses:
+        changes['addresses'] = addresses
+    return changes
+
+
+class SnapshotStore:
+    '''
+    Directory of per-device snapshots: <hostname>.json holds the last as_dict() result,
+    and <hostname>.sha256 its digest.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, hostname, suffix):
+        return os.path.join(self.directory, '{}.{}'.format(hostname, suffix))
+
+    def digest(self, hostname):
+        'Return the digest of the stored snapshot for a device, or None if there is none.'
+        try:
+            with open(self._path(hostname, 'sha256'), 'r') as infile:
+                return infile.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self, hostname):
+        'Return the stored snapshot for a device, or None if there is none.'
+        try:
+            with open(self._path(hostname, 'json'), 'r') as infile:
+                return json.load(infile)
+        except FileNotFoundError:
+            return None
+
+    def save(self, hostname, data, digest=None):
+        'Store a snapshot, replacing the previous one.'
+        for (suffix, content) in (
+                ('json', json.dumps(data, indent=4, sort_keys=True, cls=IPInterfaceEncoder)),
+                ('sha256', digest or device_digest(data))):
+            filepath = self._path(hostname, suffix)
+            tmppath = '{}.tmp'.format(filepath)
+            with open(tmppath, 'w') as outfile:
+                outfile.write(content)
+            os.replace(tmppath, filepath)
+
+    def update(self, hostname, data):
+        '''
+        Compare a new as_dict() result with the stored snapshot, then store the new one.
+        Return the change set from diff_devices, or None if the device is unchanged.
+        Unchanged devices are recognised from the stored digest alone, and aren't rewritten.
+        If the discovery was incomplete, the sections it didn't retrieve are kept from the
+        stored snapshot, rather than being lost.
+        '''
+        data = normalise(data)
+        old = None
+        if incomplete_sections(data):
+            old = self.load(hostname)
+            data = carry_over(old, data)
+        digest = device_digest(data)
+        if digest == self.digest(hostname):
+            return None
+        if old is None:
+            old = self.load(hostname)
+        changes = diff_devices(old, data)
+        self.save(hostname, data, digest)
+        return changes
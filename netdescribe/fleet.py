@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+"""
+Sharded discovery of a fleet of devices, across several worker nodes.
+
+The inventory is split between shards by consistent hashing of the hostname,
+so every node computes the same split from the same inventory without coordinating,
+and adding a shard only moves about 1/N of the devices.
+Each worker performs discovery on its own shard and writes the result to a JSON file;
+the merge step combines those files into a single fleet result, reporting any device that
+appears in more than one shard, or in none.
+
+Usage:
+    python3 -m netdescribe.fleet worker <inventory> --shard <n> --shards <N> --output <file>
+    python3 -m netdescribe.fleet merge <inventory> <shard files...> --output <file>
+    python3 -m netdescribe.fleet local <inventory> --shards <N> --output <file>
+
+'local' runs N worker processes on this machine, then merges their output.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# From this package
+from netdescribe.inventory import load_inventory
+from netdescribe.profiling import DiscoveryProfiler, memory_tracing, summarise_profiles
+from netdescribe.snmp.device_discovery import explore_entry
+from netdescribe.utils import create_logger, IPInterfaceEncoder
+
+# Included batteries
+import argparse
+import bisect
+import concurrent.futures
+import hashlib
+import json
+import os.path
+import subprocess
+import sys
+import tempfile
+
+
+class HashRing:
+    "Consistent-hash ring, mapping keys to shard numbers"
+
+    def __init__(self, shards, replicas=100):
+        '''
+        - shards: the number of shards, numbered from 0.
+        - replicas: the number of points each shard has on the ring.
+          More points give a more even split, at the cost of a larger ring.
+        '''
+        self.shards = shards
+        points = sorted((_hash('shard-{}-{}'.format(shard, replica)), shard)
+                        for shard in range(shards)
+                        for replica in range(replicas))
+        self._hashes = [point[0] for point in points]
+        self._shards = [point[1] for point in points]
+
+    def shard_for(self, key):
+        'Return the number of the shard responsible for this key.'
+        pos = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._shards[pos]
+
+def _hash(key):
+    'Stable hash of a string, identical on every node and Python process.'
+    return int(hashlib.md5(key.lower().encode('utf-8')).hexdigest()[:16], 16)
+
+
+def shard_inventory(entries, shards, replicas=100):
+    '''
+    Split a list of InventoryEntry namedtuples between shards.
+    Return a list with one list of entries per shard.
+    Repeated hostnames always land in the same shard, where run_shard reports them.
+    '''
+    ring = HashRing(shards, replicas)
+    result = [[] for _ in range(shards)]
+    for entry in entries:
+        result[ring.shard_for(entry.hostname)].append(entry)
+    return result
+
+def run_shard(entries, shard, shards, logger, workers=8, discover=None, profile=False,
+              budget=None, table_budget=None):
+    '''
+    Perform discovery on the devices in one shard of an inventory.
+    Return a dict:
+    - shard: this shard's number
+    - shards: total number of shards
+    - devices: dict of hostname -> as_dict() output, for each device discovered
+    - failed: list of hostnames on which discovery failed
+    - duplicates: hostnames that appear more than once in this shard's part of the inventory.
+      Only the first entry for each one is discovered.
+    - profiles: if 'profile' is set, dict of hostname -> DiscoveryProfiler.as_dict() output.
+      'discover' is then called with a 'profiler' keyword argument, and tracemalloc runs
+      for the whole shard.
+    'budget' and 'table_budget', if set, are passed on to 'discover' as keyword arguments;
+    see device_discovery.explore_device.
+    '''
+    discover = discover or explore_entry
+    mine = shard_inventory(entries, shards)[shard]
+    logger.info('Shard %s of %s: %s devices', shard, shards, len(mine))
+    result = {'shard': shard, 'shards': shards, 'devices': {}, 'failed': [], 'duplicates': []}
+    profilers = {}
+    kwargs = {}
+    if budget is not None:
+        kwargs['budget'] = budget
+    if table_budget is not None:
+        kwargs['table_budget'] = table_budget
+    with memory_tracing(enabled=profile), \
+            concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        seen = set()
+        for entry in mine:
+            if entry.hostname in seen:
+                logger.warning('%s appears more than once in the inventory; skipping the repeat',
+                               entry.hostname)
+                result['duplicates'].append(entry.hostname)
+                continue
+            seen.add(entry.hostname)
+            if profile:
+                profilers[entry.hostname] = DiscoveryProfiler()
+                future = executor.submit(discover, entry, logger,
+                                         profiler=profilers[entry.hostname], **kwargs)
+            else:
+                future = executor.submit(discover, entry, logger, **kwargs)
+            futures[future] = entry.hostname
+        for future in concurrent.futures.as_completed(futures):
+            hostname = futures[future]
+            try:
+                device = future.result()
+            except Exception as err:    # pylint: disable=broad-except
+                logger.error('Discovery of %s failed: %s', hostname, err)
+                device = False
+            if device:
+                result['devices'][hostname] = device.as_dict()
+            else:
+                result['failed'].append(hostname)
+    result['failed'].sort()
+    result['duplicates'] = sorted(set(result['duplicates']))
+    if profile:
+        result['profiles'] = {hostname: profiler.as_dict()
+                              for (hostname, profiler) in profilers.items()}
+    return result
+
+def merge_results(shard_results, entries=None):
+    '''
+    Combine the output of run_shard from several workers into a single fleet result.
+    Return a dict:
+    - devices: dict of hostname -> as_dict() output, across all shards
+    - failed: hostnames on which discovery failed
+    - duplicates: hostnames reported by more than one shard, or repeated within a shard's
+      part of the inventory. The result from the lowest-numbered shard is kept.
+    - missing: hostnames in the inventory that no shard reported on.
+      Only calculated if 'entries' is supplied.
+    - missingShards: shard numbers for which no output was supplied
+    - profiles: only if the shards were profiled; the output of
+      netdescribe.profiling.summarise_profiles across all shards
+    '''
+    merged = {'devices': {}, 'failed': [], 'duplicates': [], 'missing': [], 'missingShards': []}
+    profiles = {}
+    seen = set()
+    shards = set()
+    expected_shards = 0
+    for result in sorted(shard_results, key=lambda result: result['shard']):
+        shards.add(result['shard'])
+        expected_shards = max(expected_shards, result['shards'])
+        for (hostname, profile) in result.get('profiles', {}).items():
+            profiles.setdefault(hostname, profile)
+        merged['duplicates'].extend(result.get('duplicates', []))
+        reported = list(result['devices'].items()) + [(host, None) for host in result['failed']]
+        for (hostname, data) in reported:
+            if hostname in seen:
+                merged['duplicates'].append(hostname)
+                continue
+            seen.add(hostname)
+            if data is None:
+                merged['failed'].append(hostname)
+            else:
+                merged['devices'][hostname] = data
+    merged['missingShards'] = sorted(set(range(expected_shards)) - shards)
+    if entries is not None:
+        merged['missing'] = sorted(set(entry.hostname for entry in entries) - seen)
+    merged['failed'].sort()
+    merged['duplicates'] = sorted(set(merged['duplicates']))
+    if profiles:
+        merged['profiles'] = summarise_profiles(profiles)
+    return merged
+
+
+def write_result(result, filepath):
+    'Write a shard or fleet result to a file in JSON.'
+    with open(filepath, 'w') as outfile:
+        json.dump(result, outfile, indent=4, sort_keys=True, cls=IPInterfaceEncoder)
+
+def read_result(filepath):
+    'Read a shard result written by write_result.'
+    with open(filepath, 'r') as infile:
+        return json.load(infile)
+
+def run_local(inventory_path, shards, logger, workers=8, profile=False, budget=None,
+              table_budget=None):
+    '''
+    Run one worker process per shard on this machine, wait for them all to finish,
+    and return the merged result. Useful for testing, and for using several cores.
+    '''
+    entries = load_inventory(inventory_path)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        processes = []
+        for shard in range(shards):
+            outfile = os.path.join(tmpdir, 'shard-{}.json'.format(shard))
+            cmd = [sys.executable, '-m', 'netdescribe.fleet', 'worker', inventory_path,
+                   '--shard', str(shard), '--shards', str(shards),
+                   '--workers', str(workers), '--output', outfile]
+            if profile:
+                cmd.append('--profile')
+            if budget is not None:
+                cmd.extend(['--budget', str(budget)])
+            if table_budget is not None:
+                cmd.extend(['--table-budget', str(table_budget)])
+            processes.append((shard, outfile, subprocess.Popen(cmd)))
+        results = []
+        for (shard, outfile, process) in processes:
+            if process.wait() != 0 or not os.path.exists(outfile):
+                logger.error('Worker for shard %s failed with status %s',
+                             shard, process.returncode)
+                continue
+            results.append(read_result(outfile))
+    merged = merge_results(results, entries)
+    # A shard whose worker died leaves no file behind, so make sure it's reported.
+    merged['missingShards'] = sorted(set(range(shards)) - set(r['shard'] for r in results))
+    return merged
+
+
+def main():
+    '''
+    Command-line interface for workers, the merge step, and local runs.
+    '''
+    parser = argparse.ArgumentParser(description='Perform SNMP discovery on a fleet of \
+    devices, sharded across several workers.')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    subparsers = parser.add_subparsers(dest='command')
+    worker = subparsers.add_parser('worker', help='Perform discovery on one shard')
+    worker.add_argument('inventory', type=str, help='Path to the inventory file')
+    worker.add_argument('--shard', type=int, required=True, help='Number of this shard, from 0')
+    worker.add_argument('--shards', type=int, required=True, help='Total number of shards')
+    worker.add_argument('--workers', type=int, default=8,
+                        help='Maximum number of concurrent discoveries')
+    worker.add_argument('--output', type=str, required=True, help='File to write results to')
+    worker.add_argument('--profile', action='store_true',
+                        help='Record the time and memory taken by each phase, per device')
+    worker.add_argument('--budget', type=float, default=None,
+                        help='Maximum seconds to spend on each device')
+    worker.add_argument('--table-budget', type=float, default=None, dest='table_budget',
+                        help='Maximum seconds to spend on each table of a device')
+    merge = subparsers.add_parser('merge', help='Merge the results of several shards')
+    merge.add_argument('inventory', type=str, help='Path to the inventory file')
+    merge.add_argument('results', type=str, nargs='+', help='Shard result files')
+    merge.add_argument('--output', type=str, required=True, help='File to write results to')
+    local = subparsers.add_parser('local', help='Run all shards on this machine, then merge')
+    local.add_argument('inventory', type=str, help='Path to the inventory file')
+    local.add_argument('--shards', type=int, required=True, help='Number of worker processes')
+    local.add_argument('--workers', type=int, default=8,
+                       help='Maximum number of concurrent discoveries per worker')
+    local.add_argument('--output', type=str, required=True, help='File to write results to')
+    local.add_argument('--profile', action='store_true',
+                       help='Record the time and memory taken by each phase, per device')
+    local.add_argument('--budget', type=float, default=None,
+                       help='Maximum seconds to spend on each device')
+    local.add_argument('--table-budget', type=float, default=None, dest='table_budget',
+                       help='Maximum seconds to spend on each table of a device')
+    args = parser.parse_args()
+    # Suppress INFO output: workers' logs are interleaved on the same terminal.
+    logger = create_logger(loglevel="debug" if args.debug else "warning")
+    if args.command == 'worker':
+        result = run_shard(load_inventory(args.inventory), args.shard, args.shards, logger,
+                           workers=args.workers, profile=args.profile, budget=args.budget,
+                           table_budget=args.table_budget)
+    elif args.command == 'merge':
+        result = merge_results([read_result(path) for path in args.results],
+                               load_inventory(args.inventory))
+    elif args.command == 'local':
+        result = run_local(args.inventory, args.shards, logger, workers=args.workers,
+                           profile=args.profile, budget=args.budget,
+                           table_budget=args.table_budget)
+    else:
+        parser.print_help()
+        sys.exit(1)
+    write_result(result, args.output)
+    for key in ('duplicates', 'missing', 'missingShards'):
+        if result.get(key):
+            logger.warning('%s: %s', key, result[key])
+
+if __name__ == '__main__':
+    main()
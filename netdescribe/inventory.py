@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""
+Loading lists of devices to perform discovery on.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Included batteries
+from collections import namedtuple
+import json
+
+
+InventoryEntry = namedtuple('inventoryEntry', [
+    'hostname',     # Hostname or address to perform discovery on
+    'community',    # SNMP v2 community string, or a list of candidates to try
+    'port',         # UDP port the SNMP agent listens on
+    'interval',     # Seconds between discoveries; None means "use the scheduler's default"
+    'priority',     # Higher values are run first when several devices are due at once
+    ])
+
+def make_entry(hostname, community='public', port=161, interval=None, priority=0):
+    'Create an InventoryEntry, filling in the defaults.'
+    return InventoryEntry(hostname=hostname,
+                          community=community,
+                          port=int(port),
+                          interval=float(interval) if interval is not None else None,
+                          priority=int(priority))
+
+def load_inventory(filepath):
+    '''
+    Read an inventory file, and return a list of InventoryEntry namedtuples.
+    Two formats are accepted:
+    - JSON: a list whose elements are either hostnames, or dicts with the keys
+      'hostname', and optionally 'community', 'port', 'interval' and 'priority'.
+      'community' may be a list of candidate communities.
+      Alternatively, a dict of hostname -> dict of those optional keys, or null.
+    - Plain text: one hostname per line. Blank lines and lines starting with '#' are ignored.
+      This includes files that happen to parse as a JSON string or number,
+      e.g. a single hostname that's all digits.
+    '''
+    with open(filepath, 'r') as infile:
+        content = infile.read()
+    try:
+        data = json.loads(content)
+    except ValueError:
+        data = None
+    if isinstance(data, dict):
+        return [make_entry(hostname, **(options or {}))
+                for (hostname, options) in data.items()]
+    if not isinstance(data, list):
+        return [make_entry(line.strip())
+                for line in content.splitlines()
+                if line.strip() and not line.strip().startswith('#')]
+    entries = []
+    for item in data:
+        if isinstance(item, dict):
+            entries.append(make_entry(**item))
+        else:
+            entries.append(make_entry(item))
+    return entries
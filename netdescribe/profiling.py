@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+"""
+Per-phase profiling of discovery.
+
+A DiscoveryProfiler is passed to explore_device or Mib2.discover, and records the wall-clock
+time, CPU time and peak memory allocation of each phase of discovery, i.e. fingerprinting
+the device, then each of the methods listed in the device class' 'discovery_phases'.
+Optionally, it also runs cProfile across the whole discovery; the stats it dumps are in
+the standard pstats format, which flamegraph tools such as flameprof and snakeviz can read.
+Memory is only tracked while tracemalloc is running, which is process-wide; wrap the whole
+run in memory_tracing(), rather than starting and stopping it around each phase, so that
+concurrent discoveries don't switch it off underneath each other.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# Included batteries
+from collections import namedtuple, OrderedDict
+import contextlib
+import cProfile
+import time
+import tracemalloc
+
+
+PhaseStats = namedtuple('phaseStats', [
+    'phase',        # Name of the phase, e.g. 'interfaces'
+    'wall',         # Elapsed wall-clock time, in seconds
+    'cpu',          # CPU time used by the thread running the phase, in seconds
+    'peakMemory',   # Peak memory allocated during the phase, in bytes; None if not tracked
+    ])
+
+# CPU time for the current thread only, where available, so that concurrent discoveries
+# don't count each other's CPU usage.
+_cpu_time = getattr(time, 'thread_time', time.process_time)
+
+
+class DiscoveryProfiler:
+    "Records the cost of each phase of discovery on a single device"
+
+    def __init__(self, memory=True, cprofile=False):
+        '''
+        - memory: track peak memory allocation per phase, via tracemalloc, while it's
+          running; see memory_tracing(). tracemalloc is process-wide, so figures are
+          approximate when several discoveries run at once.
+        - cprofile: run cProfile across all phases, for dump_stats().
+        '''
+        self.memory = memory
+        self.phases = []    # List of PhaseStats namedtuples, in the order they ran
+        self._cprofile = cProfile.Profile() if cprofile else None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        'Context manager that records the cost of the code it wraps, as the named phase.'
+        tracing = self.memory and tracemalloc.is_tracing()
+        if tracing:
+            _reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        if self._cprofile:
+            self._cprofile.enable()
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            cpu = _cpu_time() - cpu
+            wall = time.perf_counter() - wall
+            if self._cprofile:
+                self._cprofile.disable()
+            peak = None
+            if tracing and tracemalloc.is_tracing():
+                peak = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+            self.phases.append(PhaseStats(phase=name, wall=wall, cpu=cpu, peakMemory=peak))
+
+    def total(self):
+        'Return a PhaseStats namedtuple summing all the recorded phases.'
+        peaks = [stats.peakMemory for stats in self.phases if stats.peakMemory is not None]
+        return PhaseStats(phase='total',
+                          wall=sum(stats.wall for stats in self.phases),
+                          cpu=sum(stats.cpu for stats in self.phases),
+                          peakMemory=max(peaks) if peaks else None)
+
+    def as_dict(self):
+        'Return the recorded figures as a dict, suitable for rendering in JSON.'
+        return {'phases': OrderedDict((stats.phase, stats._asdict()) for stats in self.phases),
+                'total': self.total()._asdict()}
+
+    def report(self):
+        'Return a human-readable table of the recorded figures.'
+        lines = ['{:<16} {:>10} {:>10} {:>12}'.format('phase', 'wall (s)', 'cpu (s)',
+                                                     'peak (KiB)')]
+        for stats in self.phases + [self.total()]:
+            lines.append('{:<16} {:>10.3f} {:>10.3f} {:>12}'.format(
+                stats.phase, stats.wall, stats.cpu,
+                '-' if stats.peakMemory is None else '{:.1f}'.format(stats.peakMemory / 1024)))
+        return '\n'.join(lines)
+
+    def dump_stats(self, filepath):
+        'Write the cProfile stats to a file, in pstats format.'
+        if not self._cprofile:
+            raise RuntimeError('cProfile was not enabled for this profiler')
+        self._cprofile.dump_stats(filepath)
+
+
+@contextlib.contextmanager
+def memory_tracing(enabled=True):
+    '''
+    Context manager that runs tracemalloc for the code it wraps, so that DiscoveryProfilers
+    used inside it record peak memory. Does nothing if 'enabled' is false, and leaves
+    tracemalloc alone if it was already running.
+    '''
+    started = enabled and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    try:
+        yield
+    finally:
+        if started:
+            tracemalloc.stop()
+
+def _reset_peak():
+    'Reset the tracemalloc peak, so that it covers only the current phase.'
+    # reset_peak() only arrived in Python 3.9; clearing the traces has the same effect
+    # on the peak, at the cost of also forgetting existing allocations.
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+    else:
+        tracemalloc.clear_traces()
+
+
+def summarise_profiles(profiles, top=10):
+    '''
+    Summarise the profiles from a fleet run.
+    'profiles' is a dict of hostname -> DiscoveryProfiler.as_dict() output.
+    Return a dict:
+    - slowestDevices: the 'top' hostnames with the highest total wall time,
+      with their slowest phase
+    - phases: for each phase, the total and maximum wall time across all devices,
+      and the device with the maximum
+    '''
+    slowest = []
+    phases = {}
+    for (hostname, profile) in profiles.items():
+        if not profile['phases']:
+            continue
+        worst = max(profile['phases'].values(), key=lambda stats: stats['wall'])
+        slowest.append({'hostname': hostname,
+                        'wall': profile['total']['wall'],
+                        'slowestPhase': worst['phase']})
+        for (name, stats) in profile['phases'].items():
+            summary = phases.setdefault(name, {'totalWall': 0.0, 'maxWall': 0.0, 'maxHost': None})
+            summary['totalWall'] += stats['wall']
+            if stats['wall'] >= summary['maxWall']:
+                summary['maxWall'] = stats['wall']
+                summary['maxHost'] = hostname
+    slowest.sort(key=lambda device: device['wall'], reverse=True)
+    return {'slowestDevices': slowest[:top], 'phases': phases}
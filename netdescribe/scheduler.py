@@ -0,0 +1,335 @@
+#!/usr/bin/env python3
+
+"""
+Long-running discovery service.
+Keeps a priority queue of devices, rediscovers each one at its own interval,
+and passes the results to a sink.
+
+Scheduling rules:
+- each device is rediscovered every 'interval' seconds, randomly adjusted by up to
+  +/- 'jitter' (a fraction of the interval), so that devices added together drift apart
+  instead of all firing in the same minute.
+- the first run for each device is spread across the first 'jitter' fraction of its interval.
+- when several devices are due at once, the one with the highest priority goes first.
+- at most 'workers' discoveries run at the same time.
+- a discovery that runs past its deadline is abandoned and counted as a failure.
+  Its thread can't be killed, so it keeps its worker slot until it finishes.
+- after a failure, the device is retried with exponential backoff,
+  capped at its normal interval.
+
+To test against a local simulated agent, e.g. snmpsim listening on 127.0.0.1:1161,
+give the inventory entry a hostname of 127.0.0.1 and a port of 1161.
+"""
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+# From this package
+from netdescribe.diff import SnapshotStore
+import netdescribe.files
+from netdescribe.inventory import load_inventory
+from netdescribe.snmp.credentials import CredentialCache
+from netdescribe.snmp.device_discovery import explore_entry
+from netdescribe.utils import create_logger, IPInterfaceEncoder
+
+# Included batteries
+import argparse
+import concurrent.futures
+import functools
+import heapq
+import itertools
+import json
+import os.path
+import random
+import threading
+import time
+
+
+class ScheduledDevice:
+    "A device in the scheduler's queue, with its scheduling state"
+
+    __slots__ = ['entry', 'interval', 'next_run', 'failures', 'started']
+
+    def __init__(self, entry, interval):
+        self.entry = entry              # InventoryEntry namedtuple
+        self.interval = interval        # Seconds between discoveries
+        self.next_run = None            # Monotonic time at which this device is next due
+        self.failures = 0               # Consecutive failures, for calculating backoff
+        self.started = None             # Monotonic time at which the current run started
+
+
+def json_file_sink(directory):
+    '''
+    Return a sink that writes each result to <directory>/<hostname>.json,
+    replacing the result of the previous run.
+    '''
+    def sink(hostname, device):
+        'Write the result for one device.'
+        filepath = os.path.join(directory, '{}.json'.format(hostname))
+        tmppath = '{}.tmp'.format(filepath)
+        netdescribe.files.write_json(device, tmppath)
+        os.replace(tmppath, filepath)
+    return sink
+
+def diff_sink(directory, emit=None):
+    '''
+    Return a sink that keeps the latest snapshot of each device in <directory>,
+    and passes only the changes since the previous run to emit(hostname, changes).
+    Devices that haven't changed are skipped entirely.
+    'emit' defaults to printing each change set to STDOUT, as a line of JSON.
+    '''
+    store = SnapshotStore(directory)
+    emit = emit or _print_changes
+    def sink(hostname, device):
+        'Compare the result for one device with its previous snapshot.'
+        changes = store.update(hostname, device.as_dict())
+        if changes is not None:
+            emit(hostname, changes)
+    return sink
+
+def _print_changes(hostname, changes):
+    'Print a change set to STDOUT, as a single line of JSON.'
+    print(json.dumps({'hostname': hostname, 'changes': changes}, sort_keys=True), flush=True)
+
+def stdout_sink(hostname, device):
+    'Print each result to STDOUT, as a single line of JSON.'
+    print(json.dumps({'hostname': hostname, 'device': device.as_dict()},
+                     sort_keys=True, cls=IPInterfaceEncoder), flush=True)
+
+
+class DiscoveryScheduler:
+    "Runs discovery on a set of devices, at per-device intervals, with bounded concurrency"
+
+    def __init__(self, sink, logger=None, workers=4, interval=3600, jitter=0.1,
+                 deadline=600, retry_interval=60, discover=None, seed=None, budget=None,
+                 credential_cache=None):
+        '''
+        - sink: callable(hostname, device), invoked with each successful result.
+        - workers: the maximum number of concurrent discoveries.
+        - interval: default seconds between discoveries of a device.
+        - jitter: fraction of the interval by which each run is randomly moved.
+        - deadline: seconds a discovery may take before it's abandoned.
+        - retry_interval: base delay before retrying a failed discovery.
+        - budget: seconds of SNMP traffic allowed per discovery, after which the device
+          returns whatever it has retrieved. Defaults to 90% of the deadline, leaving a
+          margin for the result to come back before the run is abandoned.
+        - credential_cache: a netdescribe.snmp.credentials.CredentialCache, for entries
+          with several candidate communities.
+        - discover: callable(entry, logger) returning a device object or False.
+          Defaults to device_discovery.explore_entry, with 'budget' and 'credential_cache',
+          so that a slow device returns what it has instead of being abandoned.
+        '''
+        self.sink = sink
+        self.logger = logger or create_logger()
+        self.workers = workers
+        self.interval = interval
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_interval = retry_interval
+        self.budget = budget if budget is not None else deadline * 0.9
+        self.discover = discover or functools.partial(explore_entry, budget=self.budget,
+                                                      credential_cache=credential_cache)
+        self._random = random.Random(seed)
+        self._queue = []    # Heap of (next_run, -priority, sequence, ScheduledDevice)
+        self._ready = []    # Heap of due devices: (-priority, next_run, sequence, ScheduledDevice)
+        self._sequence = itertools.count()
+        self._inflight = {} # Future -> ScheduledDevice
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def add(self, entry):
+        '''
+        Add an InventoryEntry to the schedule.
+        Its first run is placed randomly within the first 'jitter' fraction of its interval,
+        so that a large inventory doesn't all start at once.
+        '''
+        device = ScheduledDevice(entry, entry.interval or self.interval)
+        self._push(device, time.monotonic() + self._random.uniform(
+            0, self.jitter * device.interval))
+
+    def _push(self, device, when):
+        'Place a device in the queue.'
+        device.next_run = when
+        with self._lock:
+            heapq.heappush(self._queue,
+                           (when, -device.entry.priority, next(self._sequence), device))
+
+    def _reschedule(self, device, succeeded):
+        'Work out when this device should next run, and put it back in the queue.'
+        if succeeded:
+            device.failures = 0
+            delay = device.interval * (1 + self._random.uniform(-self.jitter, self.jitter))
+        else:
+            device.failures += 1
+            delay = min(self.retry_interval * 2 ** (device.failures - 1), device.interval)
+            delay *= 1 + self._random.uniform(0, self.jitter)
+        self.logger.debug('Next discovery of %s in %.1f seconds', device.entry.hostname, delay)
+        self._push(device, time.monotonic() + delay)
+
+    def _dispatch(self, executor, now):
+        '''
+        Start discovery on as many due devices as there are free workers.
+        Every device that's due is moved to the ready queue first, so that the one with the
+        highest priority goes first, then the one that has been due the longest.
+        '''
+        with self._lock:
+            while self._queue and self._queue[0][0] <= now:
+                (when, priority, sequence, device) = heapq.heappop(self._queue)
+                heapq.heappush(self._ready, (priority, when, sequence, device))
+        while len(self._inflight) < self.workers:
+            with self._lock:
+                if not self._ready:
+                    return
+                device = heapq.heappop(self._ready)[3]
+            self.logger.info('Starting discovery of %s', device.entry.hostname)
+            device.started = now
+            future = executor.submit(self.discover, device.entry, self.logger)
+            self._inflight[future] = device
+
+    def _collect(self, done):
+        'Handle completed discoveries, passing successful results to the sink.'
+        for future in done:
+            device = self._inflight.pop(future)
+            hostname = device.entry.hostname
+            if device.started is None:
+                # Already abandoned after passing its deadline; drop the late result.
+                self.logger.warning('Discarding late result for %s', hostname)
+                continue
+            try:
+                result = future.result()
+            except Exception as err:    # pylint: disable=broad-except
+                self.logger.error('Discovery of %s failed: %s', hostname, err)
+                result = False
+            if result:
+                self.logger.info('Completed discovery of %s in %.1f seconds',
+                                 hostname, time.monotonic() - device.started)
+                try:
+                    self.sink(hostname, result)
+                except Exception as err:    # pylint: disable=broad-except
+                    self.logger.error('Failed to write result for %s: %s', hostname, err)
+            else:
+                self.logger.warning('Discovery of %s returned no result', hostname)
+            device.started = None
+            self._reschedule(device, bool(result))
+
+    def _expire(self, now):
+        'Abandon discoveries that have run past their deadline.'
+        for future, device in list(self._inflight.items()):
+            if device.started is not None and now - device.started > self.deadline:
+                self.logger.error('Discovery of %s exceeded its deadline of %s seconds',
+                                  device.entry.hostname, self.deadline)
+                device.started = None
+                # Reschedule a copy, because the original stays in self._inflight
+                # until its thread finishes.
+                retry = ScheduledDevice(device.entry, device.interval)
+                retry.failures = device.failures
+                self._reschedule(retry, False)
+
+    def _next_wakeup(self, now):
+        'Return the number of seconds until something needs attention.'
+        candidates = [1.0]
+        with self._lock:
+            if len(self._inflight) < self.workers:
+                if self._ready:
+                    candidates.append(0)
+                elif self._queue:
+                    candidates.append(self._queue[0][0] - now)
+        for device in self._inflight.values():
+            if device.started is not None:
+                candidates.append(device.started + self.deadline - now)
+        return max(0, min(candidates))
+
+    def run(self):
+        'Run until stop() is called.'
+        self.logger.info('Starting discovery scheduler with %s workers', self.workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                self._expire(now)
+                self._dispatch(executor, now)
+                timeout = self._next_wakeup(time.monotonic())
+                if self._inflight:
+                    done, _ = concurrent.futures.wait(
+                        list(self._inflight), timeout=timeout,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                    self._collect(done)
+                else:
+                    self._stop.wait(timeout)
+        self.logger.info('Discovery scheduler stopped')
+
+    def stop(self):
+        'Ask run() to return once the current discoveries have finished.'
+        self._stop.set()
+
+
+def main():
+    '''
+    Run the scheduler as a service, from the command line.
+    '''
+    parser = argparse.ArgumentParser(description='Perform SNMP discovery on an inventory of \
+    hosts, repeatedly, as a long-running service.')
+    parser.add_argument('inventory',
+                        type=str,
+                        help='Path to the inventory file: JSON, or one hostname per line')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='Maximum number of concurrent discoveries')
+    parser.add_argument('--interval', type=float, default=3600,
+                        help='Default number of seconds between discoveries of a device')
+    parser.add_argument('--jitter', type=float, default=0.1,
+                        help='Fraction of the interval by which runs are randomly spread')
+    parser.add_argument('--deadline', type=float, default=600,
+                        help='Seconds after which a discovery is abandoned')
+    parser.add_argument('--retry-interval', type=float, default=60, dest='retry_interval',
+                        help='Base delay in seconds before retrying a failed discovery')
+    parser.add_argument('--output-dir',
+                        type=str,
+                        dest='output_dir',
+                        default=None,
+                        help='Directory to write per-device JSON results to. If this is not \
+                        specified, STDOUT will be used.')
+    parser.add_argument('--diff', action='store_true',
+                        help='Keep snapshots in the output directory, and print only the \
+                        changes since the previous run of each device to STDOUT.')
+    parser.add_argument('--credential-cache', type=str, dest='credential_cache', default=None,
+                        help='File recording which community works for each host, for \
+                        inventory entries with a list of candidate communities.')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+    logger = create_logger(loglevel="debug" if args.debug else "info")
+    cache = CredentialCache(args.credential_cache) if args.credential_cache else None
+    if args.diff:
+        if not args.output_dir:
+            parser.error('--diff requires --output-dir')
+        sink = diff_sink(args.output_dir)
+    elif args.output_dir:
+        sink = json_file_sink(args.output_dir)
+    else:
+        sink = stdout_sink
+    scheduler = DiscoveryScheduler(sink,
+                                   logger=logger,
+                                   workers=args.workers,
+                                   interval=args.interval,
+                                   jitter=args.jitter,
+                                   deadline=args.deadline,
+                                   retry_interval=args.retry_interval,
+                                   credential_cache=cache)
+    for entry in load_inventory(args.inventory):
+        scheduler.add(entry)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Normalisation of IP addresses from ipAddrTable and ipAddressTable.
+
+Addresses are decoded straight from the numeric OID index, and stored as integers
+in CompactAddress objects. The ipaddress.IPv4Interface/IPv6Interface representation
+is only created when it's asked for, which keeps hosts with tens of thousands of
+addresses cheap to discover.
+"""
+
+# Built-in modules
+import ipaddress
+
+
+# Dotted-quad netmask -> prefix length, for every contiguous netmask.
+NETMASK_PREFIXES = {str(ipaddress.IPv4Address((2 ** 32 - 1) ^ (2 ** (32 - length) - 1))): length
+                    for length in range(33)}
+
+# InetAddressType values, from INET-ADDRESS-MIB: number -> (name, IP version, octets of address)
+# The zoned types carry a 4-octet zone index after the address, which we discard.
+INET_ADDRESS_TYPES = {
+    1: ('ipv4', 4, 4),
+    2: ('ipv6', 6, 16),
+    3: ('ipv4z', 4, 4),
+    4: ('ipv6z', 6, 16),
+    }
+
+# IpAddressType values, from IP-MIB
+IP_ADDRESS_TYPES = {
+    '1': 'unicast',
+    '2': 'anycast',
+    '3': 'broadcast',
+    }
+
+
+def netmask_to_prefix(netmask):
+    '''
+    Convert a dotted-quad netmask, e.g. '255.255.255.0', to a prefix length.
+    Uses a precomputed table; non-contiguous netmasks fall back to counting the set bits.
+    '''
+    prefix = NETMASK_PREFIXES.get(netmask)
+    if prefix is None:
+        prefix = bin(int(ipaddress.IPv4Address(netmask))).count('1')
+    return prefix
+
+def arcs_to_int(arcs):
+    'Convert a sequence of octets, as found in an OID index, to an integer.'
+    return int.from_bytes(bytes(arcs), 'big')
+
+def decode_inet_address(arcs, start=0):
+    '''
+    Decode an InetAddressType/InetAddress pair from an OID index,
+    starting at position 'start' in the sequence of arcs.
+    The InetAddress is expected to be length-prefixed, as it is when it isn't the last
+    element of an index declared IMPLIED.
+    Return (type name, IP version, address as an integer, position after the address).
+    Raises ValueError for unknown or malformed address types.
+    '''
+    try:
+        (name, version, octets) = INET_ADDRESS_TYPES[arcs[start]]
+    except (KeyError, IndexError):
+        raise ValueError('Unsupported InetAddressType in index {}'.format(arcs))
+    try:
+        length = arcs[start + 1]
+    except IndexError:
+        raise ValueError('Malformed InetAddress in index {}'.format(arcs))
+    address = arcs[start + 2:start + 2 + length]
+    if length < octets or len(address) != length:
+        raise ValueError('Malformed InetAddress in index {}'.format(arcs))
+    return (name, version, arcs_to_int(address[:octets]), start + 2 + length)
+
+def octets_to_address(value):
+    '''
+    Convert an OCTET STRING value holding a raw IPv4 or IPv6 address, as rendered by pysnmp,
+    to the address in string form. pysnmp renders binary values in hex with a '0x' prefix,
+    but renders values that happen to be printable as text, so both are handled.
+    Return None if the value isn't a 4- or 16-octet address.
+    '''
+    if value.startswith('0x'):
+        try:
+            octets = bytes.fromhex(value[2:])
+        except ValueError:
+            return None
+    else:
+        octets = value.encode('latin-1', errors='ignore')
+    if len(octets) not in (4, 16):
+        return None
+    return str(ipaddress.ip_address(octets))
+
+
+class CompactAddress:
+    '''
+    An IP address configured on an interface.
+    Stored as integers; the string and ipaddress representations are derived on demand.
+    Attribute names match the ipAddress and ipAddr namedtuples in snmp_structures,
+    so existing consumers can use these objects in their place.
+    '''
+
+    __slots__ = ['ifindex', 'protocol', 'version', 'ip', 'prefix', 'addressType', '_interface']
+
+    def __init__(self, ifindex, protocol, version, ip, prefix, address_type):
+        self.ifindex = ifindex          # IF-MIB index of the interface, as a string
+        self.protocol = protocol        # Address type name: ipv4, ipv6, ipv4z or ipv6z
+        self.version = version          # IP version: 4 or 6
+        self.ip = ip                    # The address itself, as an integer
+        self.prefix = prefix            # Prefix length, as an integer
+        self.addressType = address_type # unicast, anycast, broadcast or unknown
+        self._interface = None
+
+    @property
+    def interface(self):
+        'The address as an ipaddress.IPv4Interface or IPv6Interface, created on first access.'
+        if self._interface is None:
+            if self.version == 4:
+                self._interface = ipaddress.IPv4Interface((self.ip, self.prefix))
+            else:
+                self._interface = ipaddress.IPv6Interface((self.ip, self.prefix))
+        return self._interface
+
+    @property
+    def address(self):
+        'The address as a string, without the prefix length.'
+        if self._interface is not None:
+            return str(self._interface.ip)
+        if self.version == 4:
+            return str(ipaddress.IPv4Address(self.ip))
+        return str(ipaddress.IPv6Address(self.ip))
+
+    @property
+    def prefixlength(self):
+        'The prefix length, as a string, for compatibility with the ipAddress namedtuple.'
+        return str(self.prefix)
+
+    # Compatibility with the ipAddress namedtuple
+    ipAddressIfIndex = property(lambda self: self.ifindex)
+
+    # Compatibility with the ipAddr namedtuple
+    ipAdEntIfIndex = property(lambda self: self.ifindex)
+    ipAdEntAddr = property(lambda self: self.address)
+    ipAdEntNetMask = property(lambda self: str(self.interface.netmask))
+
+    def as_dict(self):
+        'Return the dict used in the addresses section of Mib2.as_dict().'
+        return {'protocol': self.protocol,
+                'address': self.address,
+                'prefixLength': self.prefixlength,
+                'addressType': self.addressType}
+
+    def __repr__(self):
+        return 'CompactAddress(ifindex={}, address={}/{}, addressType={})'.format(
+            self.ifindex, self.address, self.prefix, self.addressType)
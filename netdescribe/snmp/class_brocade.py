@@ -23,7 +23,11 @@ Class for querying Brocade hosts via SNMP
 from netdescribe.snmp import class_mib2
 
 class Brocade(class_mib2.Mib2):
-    "Generic Linux device"
+    "Generic Brocade device, probably running Ironware"
+    # Foundry/Brocade enterprise tree
+    sys_object_id_prefixes = ['1.3.6.1.4.1.1991']
+    discovery_phases = ['identify', 'interfaces', 'ip_addresses']
+
     def __init__(self, target, engine, auth, logger, sysObjectID=None):
         class_mib2.Mib2.__init__(self, target, engine, auth, logger, sysObjectID=None)
         # Drop 'ifAlias' when querying Brocade MLX to work around Ironware's
@@ -38,10 +42,3 @@ class Brocade(class_mib2.Mib2):
             'ifAlias',
             'ifName',
             'ifHighSpeed']
-
-    def discover(self):
-        'Perform full discovery on this device, and report on the result.'
-        self.identify()
-        self.interfaces()
-        self.ip_addresses()
-        return True
@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Class for querying Juniper Junos devices via SNMP
+"""
+
+# Local modules
+
+from netdescribe.snmp import class_mib2
+
+class Junos(class_mib2.Mib2):
+    '''
+    Generic Juniper device running Junos.
+    The Mib2 behaviour works well enough for now; this class exists so that
+    Juniper-specific details have somewhere to go when they're needed.
+    '''
+    # For model specifics, see http://www.oidview.com/mibs/2636/JUNIPER-CHASSIS-DEFINES-MIB.html
+    sys_object_id_prefixes = ['1.3.6.1.4.1.2636.1.1.1']
@@ -24,10 +24,7 @@ from netdescribe.snmp import class_mib2
 
 class Linux(class_mib2.Mib2):
     "Generic Linux device"
-
-    def discover(self):
-        'Perform full discovery on this device, and report on the result.'
-        self.identify()
-        self.interfaces()
-        self.ip_addresses()
-        return True
+    # For other OSes running NetSNMP, see http://www.oidview.com/mibs/8072/NET-SNMP-TC.html
+    sys_object_id_prefixes = ['1.3.6.1.4.1.8072.3.2.10']
+    # Net-SNMP implements ipAddressTable, so there's no need for the deprecated ipAddrTable.
+    discovery_phases = ['identify', 'interfaces', 'ip_addresses']
@@ -19,18 +19,49 @@ Generic SNMP MIB-II object
 """
 
 # Local modules
-from netdescribe.snmp.snmp_functions import snmp_get, snmp_walk
-from netdescribe.snmp.snmp_structures import Interface, IpAddr, IpAddress, SystemData
+from netdescribe.snmp.addresses import (arcs_to_int, decode_inet_address, netmask_to_prefix,
+                                        octets_to_address, CompactAddress, IP_ADDRESS_TYPES)
+from netdescribe.snmp.discovery_profiles import get_profile
+from netdescribe.snmp.snmp_functions import snmp_get, snmp_walk, snmp_walk_oid, DeadlineExceeded
+from netdescribe.snmp.snmp_structures import Interface, Neighbour, SystemData
+from netdescribe.snmp.table_harvest import harvest_table
 import netdescribe.utils
 
+# Third-party libraries
+import pysnmp.hlapi
+
 # Built-in modules
 import collections
+import concurrent.futures
 import ipaddress
 import json
-import re
+import threading
+import time
+
+
+# Numeric OIDs of the IP-MIB address tables' entries
+IP_ADDR_TABLE = '1.3.6.1.2.1.4.20.1'       # ipAddrEntry
+IP_ADDRESS_TABLE = '1.3.6.1.2.1.4.34.1'    # ipAddressEntry
+# ...and of the neighbour-discovery tables
+LLDP_LOC_PORT_TABLE = '1.0.8802.1.1.2.1.3.7.1'      # lldpLocPortEntry
+LLDP_REM_TABLE = '1.0.8802.1.1.2.1.4.1.1'           # lldpRemEntry
+LLDP_REM_MAN_ADDR_TABLE = '1.0.8802.1.1.2.1.4.2.1'  # lldpRemManAddrEntry
+CDP_CACHE_TABLE = '1.3.6.1.4.1.9.9.23.1.2.1.1'      # cdpCacheEntry
+# cdpCacheAddressType values (CISCO-TC::CiscoNetworkProtocol) for IP addresses: ip, ipv6
+CDP_IP_ADDRESS_TYPES = ('1', '20')
+
+# SNMPv2-MIB scalars retrieved by identify(), in the order they're fetched
+SYSTEM_ATTRS = ['sysDescr', 'sysName', 'sysLocation', 'sysObjectID']
 
 class Mib2:
     "Generic device conforming to SNMP MIB-II"
+    # sysObjectID prefixes handled by this class; see netdescribe.snmp.device_registry.
+    # Mib2 is the fallback for anything unrecognised, so it claims none of its own.
+    sys_object_id_prefixes = []
+    # Methods called by discover(), in order.
+    discovery_phases = ['identify', 'interfaces', 'ip_addrs', 'ip_addresses']
+    # Default number of walks discover() may have in flight at once; 1 means one at a time.
+    pipeline_window = 1
 
     def __init__(self, target, engine, auth, logger, sysObjectID=None):
         # SNMP and overhead parameters
@@ -53,72 +84,221 @@ class Mib2:
             'ifAlias']
         # Device attributes
         self.system_data = None
-        self._ifnumber = None
+        self._system = {}   # SNMPv2-MIB scalars retrieved so far, by name
+        self._ifnumber = None   # ifNumber as an int, when the interfaces were last walked
         self._interfaces = None  # List of Interface namedtuples
-        self._ipaddrs = None # List of IpAddr namedtuples
-        self._ipaddresses = None # List of IpAddress namedtuples
+        self._interface_rows = {}   # ifIndex -> dict of the IF-MIB columns retrieved so far
+        self._interface_columns = set()     # Names of the IF-MIB columns retrieved so far
+        self._ipaddrs = None # List of CompactAddress objects, from ipAddrTable
+        self._ipaddresses = None # List of CompactAddress objects, from ipAddressTable
+        self._neighbours = None # List of Neighbour namedtuples, from LLDP-MIB and CDP-MIB
         # Protected attribute, to capture it if it's supplied
         self._sys_object_id = sysObjectID
+        if sysObjectID:
+            self._system['sysObjectID'] = sysObjectID
+        # What discover() retrieves; see netdescribe.snmp.discovery_profiles
+        self.profile = get_profile(None)
+        # Time budgets, as time.monotonic() values; see discover()
+        self.deadline = None    # For the whole device
+        self._phase_deadline = None     # For the phase currently running
+        # Outcome of each discovery phase: complete, timeout, error or skipped
+        self.phase_status = collections.OrderedDict()
+        self.timed_out_phase = None     # The first phase that ran out of time, if any
+        # Walks started ahead of the phases that need them: (kind, request) -> Future
+        self._prefetched = {}
+        self._local = threading.local()
+
+    def _deadline(self):
+        'Return the earlier of the device and phase deadlines, or None if neither is set.'
+        deadlines = [deadline for deadline in (self.deadline, self._phase_deadline)
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
 
     def __get(self, attribute, mib='SNMPv2-MIB'):
         'Convenience function for performing SNMP GET'
-        return snmp_get(self.engine, self.auth, self.target, mib, attribute, self.logger)
+        return snmp_get(self.engine, self.auth, self.target, mib, attribute, self.logger,
+                        deadline=self._deadline())
 
     def __walk(self, table, row):
         'Convenience function for performing SNMP WALK'
-        return snmp_walk(self.engine, self.auth, self.target, table, row, self.logger)
+        if ('walk', (table, row)) in self._prefetched:
+            return self._collect(('walk', (table, row)))
+        return snmp_walk(self.engine, self.auth, self.target, table, row, self.logger,
+                         deadline=self._deadline())
+
+    def __walk_oid(self, oid):
+        'Convenience function for performing SNMP WALK on a numeric OID'
+        if ('walk_oid', oid) in self._prefetched:
+            return self._collect(('walk_oid', oid))
+        return snmp_walk_oid(self.engine, self.auth, self.target, oid, self.logger,
+                             deadline=self._deadline())
+
+    def phase_walks(self, phase):
+        '''
+        Return the walks that a discovery phase will perform, as (kind, request) tuples:
+        ('walk', (MIB, object name)) or ('walk_oid', numeric OID).
+        Used by discover() to start them ahead of time; phases not listed here
+        simply run their walks when they're called.
+        '''
+        if phase == 'interfaces':
+            return [('walk', ('IF-MIB', row)) for row in self._if_columns()
+                    if row not in self._interface_columns]
+        if phase == 'ip_addrs' and self._ipaddrs is None:
+            return [('walk_oid', IP_ADDR_TABLE + '.' + column) for column in ('2', '3')]
+        if phase == 'ip_addresses' and self._ipaddresses is None:
+            return [('walk_oid', IP_ADDRESS_TABLE + '.' + column) for column in ('3', '5', '4')]
+        return []
+
+    def _fetch(self, walk, device_deadline, table_budget):
+        '''
+        Perform a walk in a pipeline thread, within the device deadline and the table budget.
+        The device deadline is passed in, rather than read from self.deadline, because the
+        walk may still be running after discover() has returned and reset that.
+        pysnmp engines aren't safe to share between threads, so each thread gets its own.
+        '''
+        deadlines = [deadline for deadline in (
+            device_deadline,
+            time.monotonic() + table_budget if table_budget is not None else None)
+                     if deadline is not None]
+        deadline = min(deadlines) if deadlines else None
+        engine = getattr(self._local, 'engine', None)
+        if engine is None:
+            engine = self._local.engine = pysnmp.hlapi.SnmpEngine()
+        (kind, request) = walk
+        if kind == 'walk':
+            return snmp_walk(engine, self.auth, self.target, request[0], request[1],
+                             self.logger, deadline=deadline)
+        return snmp_walk_oid(engine, self.auth, self.target, request, self.logger,
+                             deadline=deadline)
+
+    def _collect(self, walk):
+        '''
+        Wait for a prefetched walk, within the current deadline, and return its result.
+        Raises whatever the walk raised, or DeadlineExceeded if the wait runs out of time.
+        '''
+        future = self._prefetched.pop(walk)
+        deadline = self._deadline()
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        try:
+            return future.result(timeout=timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise DeadlineExceeded('Deadline exceeded waiting for {}'.format(walk[1]))
+
+    def _start_pipeline(self, executor, phases, table_budget):
+        'Submit the walks of the given discovery phases to the executor.'
+        for phase in phases:
+            for walk in self.phase_walks(phase):
+                self._prefetched[walk] = executor.submit(self._fetch, walk, self.deadline,
+                                                         table_budget)
+
+    def _system_value(self, attribute):
+        'Return an SNMPv2-MIB scalar, fetching it from the device if it hasn´t been already.'
+        if attribute not in self._system:
+            self._system[attribute] = self.__get(attribute)
+            if attribute == 'sysObjectID':
+                self._sys_object_id = self._system[attribute]
+            self._update_system_data()
+        return self._system[attribute]
+
+    def _update_system_data(self):
+        'Rebuild self.system_data from the scalars retrieved so far.'
+        self.system_data = SystemData(sysName=self._system.get('sysName'),
+                                      sysDescr=self._system.get('sysDescr'),
+                                      sysObjectID=self._system.get('sysObjectID'),
+                                      sysLocation=self._system.get('sysLocation'))
+
+    # Lazy attributes: each is fetched from the device the first time it's accessed.
+    sys_name = property(lambda self: self._system_value('sysName'), doc='sysName')
+    sys_descr = property(lambda self: self._system_value('sysDescr'), doc='sysDescr')
+    sys_object_id = property(lambda self: self._system_value('sysObjectID'), doc='sysObjectID')
+    sys_location = property(lambda self: self._system_value('sysLocation'), doc='sysLocation')
+
+    @property
+    def interface_names(self):
+        'dict of ifIndex -> ifName. Only walks IF-MIB::ifName, and only on first access.'
+        return {iface.ifIndex: iface.ifName for iface in self.interfaces(columns=['ifName']) or []}
+
+    @property
+    def addresses(self):
+        '''
+        The device's IP addresses, as a list of CompactAddress objects, fetched on first access.
+        Taken from ipAddressTable, or ipAddrTable on devices that don't implement that.
+        Doesn't walk IF-MIB.
+        '''
+        return self.ip_addresses() or self.ip_addrs()
 
     def identify(self):
         '''
         Return an snmp.snmp_structures.systemData namedtuple.
         Memoised method: if the object already has this data, it won't re-poll the device.
+        Only the scalars named in the discovery profile are fetched; the others are None
+        until they're accessed via the sys_* attributes.
         '''
         hostname = self.target.transportAddr[0]
         self.logger.debug('Returning basic details for %s', hostname)
-        # If this data isn't already present, retrieve and set it.
-        if not self.system_data:
-            self.logger.debug('system_data attribute is null; polling the device for details.')
-            sys_descr = self.__get('sysDescr')
-            sys_name = self.__get('sysName')
-            sys_location = self.__get('sysLocation')
-            if not self._sys_object_id:
-                self._sys_object_id = self.__get('sysObjectID')
-            self.system_data = SystemData(sysName=sys_name,
-                                          sysDescr=sys_descr,
-                                          sysObjectID=self._sys_object_id,
-                                          sysLocation=sys_location)
-            self.logger.debug('Retrieved data %s', self.system_data)
+        # Retrieve whichever of the requested scalars we don't already have.
+        wanted = SYSTEM_ATTRS if self.profile.system is None else self.profile.system
+        for attribute in wanted:
+            self._system_value(attribute)
+        if self.system_data is None:
+            self._update_system_data()
+        self.logger.debug('Retrieved data %s', self.system_data)
         # Return the cached data
         return self.system_data
 
-    def interfaces(self):
+    def _if_columns(self, columns=None):
+        '''
+        Return the IF-MIB columns to walk: those requested, or else those in the discovery
+        profile, limited to the ones this class walks, i.e. self._if_mib_attrs.
+        '''
+        if columns is None:
+            columns = self.profile.if_columns
+        if columns is None:
+            return list(self._if_mib_attrs)
+        return [column for column in self._if_mib_attrs if column in columns]
+
+    def interfaces(self, columns=None):
         '''
         Return a list of Interface namedtuples.
-        If self.interfaces already contains a number of elements matching self._ifnumber,
-        it will simply return that list.
-        If not, it will query the device to populate that list first.
+        'columns' lists the IF-MIB columns to retrieve; it defaults to those in the discovery
+        profile, which is all of them unless otherwise specified. Columns that haven't been
+        retrieved are empty strings.
+        If those columns have already been retrieved, it will simply return the cached list.
+        If not, it will query the device for the missing columns first, starting again with
+        all of them if ifNumber has changed since the interfaces were last walked.
         '''
+        columns = self._if_columns(columns)
+        missing = [column for column in columns if column not in self._interface_columns]
         # If it's already sorted, return the contents
-        # Note: this approach doesn't work on Linux, because ifNumber isn't implemented there
-        if self.interfaces and self._ifnumber and len(self.interfaces) == self._ifnumber:
-            return self.interfaces
+        if not missing and self._interfaces:
+            return self._interfaces
         # If it's not, get the data.
         # First, find out how many interfaces it should have
         ifnumber = self.__get('ifNumber', mib='IF-MIB')
         if not ifnumber:
             self.logger.error('Failed to retrieve ifNumber')
             return False
+        # Linux doesn't implement ifNumber, so the agent's noSuchObject comes back as text;
+        # the number of interfaces is then unknown, and can't be used to spot changes.
+        ifnumber = int(ifnumber) if str(ifnumber).isdigit() else None
+        # If the number of interfaces has changed, start again
+        if (self._interfaces and ifnumber is not None and self._ifnumber is not None
+                and ifnumber != self._ifnumber):
+            self._interface_rows = {}
+            self._interface_columns = set()
+            missing = columns
         self._ifnumber = ifnumber
         # Now retrieve the interface data
-        interfaces = {}
-        for row in self._if_mib_attrs:
+        for row in missing:
             for item in self.__walk('IF-MIB', row):
-                if item.oid not in interfaces:
-                    interfaces[item.oid] = collections.defaultdict(str)
-                interfaces[item.oid][row] = item.value
+                if item.oid not in self._interface_rows:
+                    self._interface_rows[item.oid] = collections.defaultdict(str)
+                self._interface_rows[item.oid][row] = item.value
+            self._interface_columns.add(row)
         # Having retrieved the data, create the list
         interfacelist = []
-        for index, details in interfaces.items():
+        for index, details in self._interface_rows.items():
             interfacelist.append(Interface(ifIndex=index,
                                            ifDescr=details['ifDescr'],
                                            ifType=details['ifType'],
@@ -128,152 +308,189 @@ class Mib2:
                                            ifHighSpeed=details['ifHighSpeed'],
                                            ifAlias=details['ifAlias']))
         self._interfaces = interfacelist
-        # Return the data we fetches, but as it's cached in the object
-        return self.interfaces
+        # Return the data we fetched, but as it's cached in the object
+        return self._interfaces
 
     def ip_addresses(self):
         '''
-        Return the device´s IP address table, as a list of ipAddress namedtuples.
+        Return the device´s IP address table, as a list of CompactAddress objects.
         Polls the preferred, but less widely-implemented, ipAddressTable.
         If this isn't already populated, queries the device first.
         NB: Covers both IPv4 and IPv6.
         '''
         # If we already have this data, just return it
-        if self._ipaddresses:
+        if self._ipaddresses is not None:
             return self._ipaddresses
         # We don't already have it. Fetch it, then return it.
-        # First, fetch the data.
+        # The index of each row is the address itself, as an InetAddressType followed by a
+        # length-prefixed InetAddress, so it can be decoded directly from the OID arcs.
         self.logger.debug('Retrieving IP addresses from ipAddressTable')
-        acc = {}    # Intermediate accumulator for building up a map
-        # acc structure:
-        # - index = SNMP index for ipAddressTable, e.g. ipv4."192.168.124.1"
-        #   - index = SNMP index
-        #   - address = IP address
-        #   - protocol = IP protocol version, i.e. ipv4 or ipv6
-        #   - prefixlength = integer, 0-32
-        #   - type = address type: unicast, multicast or broadcast
         self.logger.debug('Retrieving indices and addresses')
-        # ipAddressIfIndex
-        # - the value is the relevant interface's IF-MIB index
-        # - the OID/index contains the address type (IPv4 vs IPv6) and the address itself,
-        #   separated by a dot.
-        #   The address is wrapped in quotes, hence the offset indices at each end.
-        for item in self.__walk('IP-MIB', 'ipAddressIfIndex'):
-            protocol = re.split('\.', item.oid)[0]
-            acc[item.oid] = {'ipAddressIfIndex': item.value,
-                             # Extract the address and protocol from the OID/index
-                             'protocol': protocol,
-                             'address': item.oid[(len(protocol) + 2):][0:-1]}
-            self.logger.debug('Initialising address in the accumulator with %s', acc[item.oid])
-        self.logger.debug('Retrieving prefix lengths')
+        ifindices = {item.oid: item.value
+                     for item in self.__walk_oid(IP_ADDRESS_TABLE + '.3')}   # ipAddressIfIndex
         # Prefix length / ipAddressPrefix
-        # The value for this OID contains all sorts of crap prepended to the actual prefix-length,
-        # so we have to break it up and extract the last element from the resulting list.
-        for item in self.__walk('IP-MIB', 'ipAddressPrefix'):
-            prefixlength = re.split('\.', item.value)[-1]
-            acc[item.oid]['prefixlength'] = prefixlength
-            self.logger.debug('Accumulated prefixlength %s for address %s',
-                              prefixlength, item.oid)
+        # The value is a pointer into ipAddressPrefixTable, whose last arc is the prefix-length.
+        # When queried for ipAddressPrefix, Brocade Ironware returns zeroDotZero,
+        # i.e. '0.0', which conveniently yields a prefix-length of 0.
+        self.logger.debug('Retrieving prefix lengths')
+        prefixes = {item.oid: int(item.value.rsplit('.', 1)[-1])
+                    for item in self.__walk_oid(IP_ADDRESS_TABLE + '.5')}   # ipAddressPrefix
         # Types - unicast, anycast or broadcast.
         # No multicast here; these are handled in another table again.
         self.logger.debug('Retrieving address types')
-        for item in self.__walk('IP-MIB', 'ipAddressType'):
-            acc[item.oid]['addressType'] = item.value
-            self.logger.debug('Accumulated type %s for address %s', item.value, item.oid)
+        types = {item.oid: IP_ADDRESS_TYPES.get(item.value, item.value)
+                 for item in self.__walk_oid(IP_ADDRESS_TABLE + '.4')}  # ipAddressType
         # Populate self._ipaddresses
-        self._ipaddresses = [IpAddress(ipAddressIfIndex=details['ipAddressIfIndex'],
-                                       protocol=details['protocol'],
-                                       address=details['address'],
-                                       prefixlength=details['prefixlength'],
-                                       addressType=details['addressType'])
-                             for _, details in acc.items()]
+        result = []
+        for (index, ifindex) in ifindices.items():
+            try:
+                (protocol, version, address, _) = decode_inet_address(index)
+            except ValueError as err:
+                self.logger.warning('Skipping ipAddressTable row: %s', err)
+                continue
+            result.append(CompactAddress(ifindex=ifindex,
+                                         protocol=protocol,
+                                         version=version,
+                                         ip=address,
+                                         prefix=prefixes.get(index, 0),
+                                         address_type=types.get(index, 'unknown')))
+        self._ipaddresses = result
         # Now return it
         return self._ipaddresses
 
     def ip_addresses_to_dict(self):
         '''
-        Convert the list of ipAddress namedtuples to a dict whose keys
+        Convert the list of ipAddressTable entries to a dict whose keys
         are the ipAddressIfIndex value, i.e. the IF-MIB index for that interface.
         Intended as a helper function for combining addresses with interfaces.
         '''
         acc = collections.defaultdict(list)
         for address in self._ipaddresses:
-            # When queried for ipAddressPrefix, Brocade Ironware returns an upraised middle finger
-            # in the form of SNMPv2-SMI::zeroDotZero.
-            # Catch and handle this case.
-            if address.prefixlength == 'SNMPv2-SMI::zeroDotZero':
-                prefix = 0
-            else:
-                prefix = address.prefixlength
-            # Now assemple it
-            acc[address.ipAddressIfIndex].append({'protocol': address.protocol,
-                                                  'address': address.address,
-                                                  'prefixLength': prefix,
-                                                  'addressType': address.addressType})
+            acc[address.ifindex].append(address.as_dict())
         return acc
 
     def ip_addrs(self):
         '''
-        Return the device´s IP address table, as a list of ipAddr namedtuples.
+        Return the device´s IP address table, as a list of CompactAddress objects.
         Derived from the deprecated but still widely-used ipAddrTable.
         If this isn't already populated, queries the device first.
         NB: Ipv4-only, by definition.
         '''
         # If we already have this data, just return it
-        if self._ipaddrs:
+        if self._ipaddrs is not None:
             return self._ipaddrs
         # We don't already have it. Fetch it, then return it.
-        # First, fetch the data.
-        acc = {}    # Intermediate accumulator for building up a map
-        # acc structure:
-        # - index = SNMP index for ipAddressTable, e.g. ipv4."192.168.124.1"
-        #   - index = SNMP index
-        #   - address = IP address
-        #   - protocol = IP protocol version, i.e. ipv4 or ipv6
-        #   - prefixlength = integer, 0-32
-        #   - type = address type: unicast, multicast or broadcast
+        # The index of each row is the address itself, so there's no need to walk ipAdEntAddr.
         self.logger.debug('Retrieving IPv4 addresses from ipAddrTable')
-        for item in self.__walk('IP-MIB', 'ipAdEntAddr'):
-            self.logger.debug('Initialising address {} in the accumulator with index {}'.format(
-                item.value, item.oid))
-            acc[item.oid] = {'address': item.value}
         self.logger.debug('Retrieving indices')
-        for item in self.__walk('IP-MIB', 'ipAdEntIfIndex'):
-            self.logger.debug('Augmenting {} with interface index {}'.format(item.value, item.oid))
-            acc[item.oid]['index'] = item.value
+        ifindices = {item.oid: item.value
+                     for item in self.__walk_oid(IP_ADDR_TABLE + '.2')}  # ipAdEntIfIndex
         self.logger.debug('Retrieving netmasks')
-        for item in self.__walk('IP-MIB', 'ipAdEntNetMask'):
-            self.logger.debug('Augmenting {} with netmask {}'.format(item.value, item.oid))
-            acc[item.oid]['netmask'] = item.value
-        # Assemble the fetched data into a list of IpAddr namedtuples
-        self._ipaddrs = [IpAddr(ipAdEntAddr=details['address'],
-                                ipAdEntIfIndex=details['index'],
-                                ipAdEntNetMask=details['netmask'])
-                         for index, details in acc.items()]
+        prefixes = {item.oid: netmask_to_prefix(item.value)
+                    for item in self.__walk_oid(IP_ADDR_TABLE + '.3')}  # ipAdEntNetMask
+        # Assemble the fetched data into a list of addresses
+        self._ipaddrs = [CompactAddress(ifindex=ifindex,
+                                        protocol='ipv4',    # IPv4-only table
+                                        version=4,
+                                        ip=arcs_to_int(index),
+                                        prefix=prefixes.get(index, 32),
+                                        address_type='unknown')
+                         for (index, ifindex) in ifindices.items()
+                         if len(index) == 4]
         # Now return it
         return self._ipaddrs
 
     def ip_addrs_to_dict(self):
         '''
-        Convert the list of ipAddr namedtuples to a dict whose keys are the ipAdEntIfIndex value,
+        Convert the list of ipAddrTable entries to a dict whose keys are the ipAdEntIfIndex value,
         i.e. the IF-MIB index for the associated interface.
-        Converts the netmask to a prefix-length, for consistency with the ipAddresses table.
+        The netmask has already been converted to a prefix-length, for consistency with the
+        ipAddresses table.
         Intended as a helper function for combining addresses with interfaces.
         '''
         result = collections.defaultdict(list)
         for addr in self._ipaddrs:
-            # Derive the prefixlength, and get a simpler varname for address while we're at it.
-            (address, prefixlength) = re.split(
-                '/',
-                ipaddress.IPv4Interface('{}/{}'.format(addr.ipAdEntAddr,
-                                                       addr.ipAdEntNetMask)).with_prefixlen)
-            # Assemble and insert the actual entry
-            result[addr.ipAdEntIfIndex].append({'protocol': 'ipv4',    # IPv4-only table
-                                                'address': address,
-                                                'prefixLength': prefixlength,
-                                                'addressType': 'unknown'})
+            result[addr.ifindex].append(addr.as_dict())
         return result
 
+    def lldp_neighbours(self):
+        '''
+        Return the neighbours reported in LLDP-MIB's lldpRemTable, as a list of
+        Neighbour namedtuples. Management addresses come from lldpRemManAddrTable,
+        whose index contains the address; only IPv4 and IPv6 addresses are used.
+        '''
+        self.logger.debug('Retrieving LLDP neighbours')
+        # lldpRemTable is indexed by (lldpRemTimeMark, lldpRemLocalPortNum, lldpRemIndex)
+        names = {item.oid: item.value
+                 for item in self.__walk_oid(LLDP_REM_TABLE + '.9')}    # lldpRemSysName
+        if not names:
+            return []
+        ports = {item.oid: item.value
+                 for item in self.__walk_oid(LLDP_REM_TABLE + '.7')}    # lldpRemPortId
+        # lldpLocPortId, indexed by lldpLocPortNum
+        local_ports = {item.oid[0]: item.value
+                       for item in self.__walk_oid(LLDP_LOC_PORT_TABLE + '.3')}
+        # lldpRemManAddrTable's index is the lldpRemTable index, followed by
+        # lldpRemManAddrSubtype (IANA address family: 1 = IPv4, 2 = IPv6) and the address.
+        addresses = {}
+        for item in self.__walk_oid(LLDP_REM_MAN_ADDR_TABLE + '.3'):  # lldpRemManAddrIfSubtype
+            (index, subtype, length) = (item.oid[:3], item.oid[3], item.oid[4])
+            if subtype in (1, 2) and length in (4, 16) and index not in addresses:
+                addresses[index] = str(ipaddress.ip_address(bytes(item.oid[5:5 + length])))
+        return [Neighbour(protocol='lldp',
+                          localPort=local_ports.get(index[1], str(index[1])),
+                          remoteName=name,
+                          remotePort=ports.get(index, ''),
+                          remoteAddress=addresses.get(index))
+                for (index, name) in names.items()]
+
+    def cdp_neighbours(self):
+        '''
+        Return the neighbours reported in Cisco's CDP-MIB cdpCacheTable, as a list of
+        Neighbour namedtuples. Returns an empty list on devices that don't implement it.
+        Only IP addresses are used, because the crawler goes on to discover them;
+        neighbours reporting addresses of other protocols have no remoteAddress.
+        '''
+        self.logger.debug('Retrieving CDP neighbours')
+        # cdpCacheTable is indexed by (cdpCacheIfIndex, cdpCacheDeviceIndex)
+        names = {item.oid: item.value
+                 for item in self.__walk_oid(CDP_CACHE_TABLE + '.6')}   # cdpCacheDeviceId
+        if not names:
+            return []
+        ports = {item.oid: item.value
+                 for item in self.__walk_oid(CDP_CACHE_TABLE + '.7')}   # cdpCacheDevicePort
+        # cdpCacheAddressType
+        address_types = {item.oid: str(item.value)
+                         for item in self.__walk_oid(CDP_CACHE_TABLE + '.3')}
+        addresses = {item.oid: octets_to_address(item.value)
+                     for item in self.__walk_oid(CDP_CACHE_TABLE + '.4')   # cdpCacheAddress
+                     if address_types.get(item.oid) in CDP_IP_ADDRESS_TYPES}
+        # The local port is identified by ifIndex; use its name, if we have it.
+        ifnames = {iface.ifIndex: iface.ifName for iface in self._interfaces or []}
+        return [Neighbour(protocol='cdp',
+                          localPort=ifnames.get(str(index[0])) or str(index[0]),
+                          remoteName=name,
+                          remotePort=ports.get(index, ''),
+                          remoteAddress=addresses.get(index))
+                for (index, name) in names.items()]
+
+    def neighbours(self):
+        '''
+        Return this device's LLDP and CDP neighbours, as a list of Neighbour namedtuples.
+        Memoised method: if the object already has this data, it won't re-poll the device.
+        '''
+        if self._neighbours is None:
+            self._neighbours = self.lldp_neighbours() + self.cdp_neighbours()
+        return self._neighbours
+
+    def harvest(self, table, store, max_rows=None, max_seconds=None):
+        '''
+        Stream one of the large tables in netdescribe.snmp.table_harvest.TABLES,
+        e.g. 'ipNetToPhysicalTable', into a TableStore on disk, instead of holding it in memory.
+        Return a HarvestResult namedtuple; the rows are read back via store.iter_rows(table).
+        '''
+        return harvest_table(self, table, store, max_rows=max_rows, max_seconds=max_seconds)
+
     def ifaces_with_addrs(self):
         '''
         Return a dict of dicts:
@@ -307,8 +524,8 @@ class Mib2:
         # This simplifies the code in the next section, by removing the need for a conditional.
         else:
             addresslist = collections.defaultdict(list)
-        # Now iterate over the interfaces
-        for iface in self._interfaces:
+        # Now iterate over the interfaces, if we got that far
+        for iface in self._interfaces or []:
             # Assemble and insert the entry
             result[iface.ifName] = {'ifIndex': iface.ifIndex,
                                     'ifDescr': iface.ifDescr,
@@ -321,13 +538,29 @@ class Mib2:
                                     'addresses': addresslist[iface.ifIndex]}
         return result
 
+    def discovery_status(self):
+        '''
+        Return a dict describing how complete discovery was:
+        - complete: True if every phase completed
+        - phases: dict of phase name -> complete, timeout, error, skipped, or not-run for
+          phases left out by the discovery profile
+        - timedOutPhase: the first phase that ran out of time, or None
+        '''
+        return {'complete': bool(self.phase_status) and all(
+                    status == 'complete' for status in self.phase_status.values()),
+                'phases': dict(self.phase_status),
+                'timedOutPhase': self.timed_out_phase}
+
     def as_dict(self):
         'Return the object´s contents as a dict'
-        return {'system': {'sysDescr': self.system_data.sysDescr,
-                           'sysObjectID': self.system_data.sysObjectID,
-                           'sysName': self.system_data.sysName,
-                           'sysLocation': self.system_data.sysLocation},
-                'interfaces': self.ifaces_with_addrs()}
+        system = self.system_data or SystemData(sysName=None, sysDescr=None,
+                                                sysObjectID=self._sys_object_id, sysLocation=None)
+        return {'system': {'sysDescr': system.sysDescr,
+                           'sysObjectID': system.sysObjectID,
+                           'sysName': system.sysName,
+                           'sysLocation': system.sysLocation},
+                'interfaces': self.ifaces_with_addrs(),
+                'discovery': self.discovery_status()}
 
     def as_json(self):
         'Return a print representation of this object'
@@ -340,10 +573,83 @@ class Mib2:
         'Return a print representation of this object'
         return self.as_json()
 
-    def discover(self):
-        'Perform full discovery on this device, and report on the result.'
-        self.identify()
-        self.interfaces()
-        self.ip_addrs()
-        self.ip_addresses()
+    def discover(self, profiler=None, deadline=None, table_budget=None, window=None,
+                 profile=None):
+        '''
+        Perform discovery on this device, and report on the result.
+        Calls each of the methods named in self.discovery_phases.
+        - profile: a netdescribe.snmp.discovery_profiles.DiscoveryProfile, or the name of one,
+          e.g. 'names', limiting discovery to some of the phases, system scalars and
+          IF-MIB columns. By default, everything is retrieved.
+        If a netdescribe.profiling.DiscoveryProfiler is supplied, the cost of each phase
+        is recorded in it.
+        - deadline: time.monotonic() value by which discovery of the whole device must finish.
+          It only applies to this call; lazy attributes read afterwards aren't bound by it.
+        - table_budget: the most seconds any one phase may take.
+        A phase that runs out of time, or fails with an SNMP error, is recorded in
+        self.phase_status and discovery moves on to the next one, so that the tables already
+        retrieved are kept. Once the device deadline has passed, the remaining phases are
+        skipped. discovery_status() summarises the outcome.
+        - window: the number of walks that may be in flight at once; defaults to
+          self.pipeline_window. Above 1, the walks listed by phase_walks() are all started
+          up front, so that the device's tables are retrieved side by side, and each phase
+          picks up its results as they arrive. A walk's table budget then starts when the
+          walk does.
+        '''
+        previous_deadline = self.deadline
+        if deadline is not None:
+            self.deadline = deadline
+        if profile is not None:
+            self.profile = get_profile(profile)
+        phases = [phase for phase in self.discovery_phases
+                  if self.profile.phases is None or phase in self.profile.phases]
+        # Record the phases the profile leaves out, unless an earlier discovery ran them.
+        for phase in self.discovery_phases:
+            if phase not in phases:
+                self.phase_status.setdefault(phase, 'not-run')
+        window = window or self.pipeline_window
+        executor = None
+        try:
+            if window > 1:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=window)
+                self._start_pipeline(executor, phases, table_budget)
+            self._run_phases(phases, profiler, table_budget)
+        finally:
+            self.deadline = previous_deadline
+            if executor:
+                # Don't start any walks that no phase is waiting for any more, and leave
+                # those already running to finish in the background, within the deadline,
+                # rather than holding up discover() until they do.
+                for future in self._prefetched.values():
+                    future.cancel()
+                self._prefetched = {}
+                executor.shutdown(wait=False)
         return True
+
+    def _run_phases(self, phases, profiler, table_budget):
+        'Call each of the given discovery phases in turn, recording their outcomes.'
+        for phase in phases:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                self.phase_status[phase] = 'skipped'
+                continue
+            if table_budget is not None:
+                self._phase_deadline = time.monotonic() + table_budget
+            try:
+                if profiler:
+                    with profiler.phase(phase):
+                        getattr(self, phase)()
+                else:
+                    getattr(self, phase)()
+                self.phase_status[phase] = 'complete'
+            except DeadlineExceeded:
+                self.logger.warning('Ran out of time during %s on %s',
+                                    phase, self.target.transportAddr[0])
+                self.phase_status[phase] = 'timeout'
+                if self.timed_out_phase is None:
+                    self.timed_out_phase = phase
+            except RuntimeError as err:
+                self.logger.error('Phase %s failed on %s: %s',
+                                  phase, self.target.transportAddr[0], err)
+                self.phase_status[phase] = 'error'
+            finally:
+                self._phase_deadline = None
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+High-frequency polling of interface counters, on a device that's already been discovered.
+
+Reuses the device's SNMP engine, credentials and transport, and the ifIndex list from
+Mib2.interfaces(), so polling costs only the GETs for the counters themselves.
+As many counter OIDs as the agent will accept are packed into each GET;
+if the agent reports tooBig, the batch size is halved and remembered for later polls,
+then doubled again after a run of polls without tooBig, in case the limit was transient.
+
+Samples are kept per interface in a fixed-size ring buffer of packed arrays,
+rather than lists of Python objects, so that tens of thousands of interfaces
+can be held in one process.
+"""
+
+# Local modules
+from netdescribe.snmp.snmp_functions import snmp_get_many, SnmpTooBig
+
+# Built-in modules
+from array import array
+from collections import OrderedDict
+import concurrent.futures
+import time
+
+
+# Counters to poll by default: name -> (numeric column OID, counter width in bits)
+COUNTERS = OrderedDict([
+    ('ifHCInOctets', ('1.3.6.1.2.1.31.1.1.1.6', 64)),
+    ('ifHCOutOctets', ('1.3.6.1.2.1.31.1.1.1.10', 64)),
+    ('ifInDiscards', ('1.3.6.1.2.1.2.2.1.13', 32)),
+    ('ifInErrors', ('1.3.6.1.2.1.2.2.1.14', 32)),
+    ('ifOutDiscards', ('1.3.6.1.2.1.2.2.1.19', 32)),
+    ('ifOutErrors', ('1.3.6.1.2.1.2.2.1.20', 32)),
+    ])
+
+# sysUpTime is fetched with each poll, so that counter resets from a reboot
+# can be told apart from counter wraps.
+SYS_UPTIME = '1.3.6.1.2.1.1.3.0'
+
+# Stored in place of a value that the agent didn't return.
+MISSING = 2 ** 64 - 1
+
+# Number of consecutive polls without tooBig, after which a reduced batch size is doubled.
+GROW_AFTER = 10
+
+
+def _counter_value(value):
+    'Convert a counter or sysUpTime value to an int, or MISSING if it is not a number.'
+    if value is None or not str(value).isdigit():
+        return MISSING
+    return int(value)
+
+
+class RingBuffer:
+    '''
+    Fixed-size history of counter samples for one interface.
+    Holds, for each sample, a timestamp, the agent's sysUpTime and one value per counter.
+    '''
+
+    __slots__ = ['size', 'width', 'times', 'uptimes', 'values', 'count', 'head']
+
+    def __init__(self, size, width):
+        self.size = size                        # Maximum number of samples retained
+        self.width = width                      # Number of counters per sample
+        self.times = array('d', [0.0] * size)   # Local time.time() of each sample
+        self.uptimes = array('Q', [0] * size)   # sysUpTime of each sample, in centiseconds
+        self.values = array('Q', [0] * (size * width))
+        self.count = 0                          # Number of samples currently held
+        self.head = 0                           # Position of the next sample to be written
+
+    def append(self, timestamp, uptime, values):
+        'Add a sample, overwriting the oldest one if the buffer is full.'
+        self.times[self.head] = timestamp
+        self.uptimes[self.head] = uptime
+        offset = self.head * self.width
+        self.values[offset:offset + self.width] = array('Q', values)
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def _position(self, age):
+        'Return the slot holding the sample "age" steps back from the newest, 0 being newest.'
+        return (self.head - 1 - age) % self.size
+
+    def sample(self, age=0):
+        '''
+        Return (timestamp, uptime, values) for the sample "age" steps back from the newest.
+        Missing values, including a missing uptime, are returned as None.
+        '''
+        if age >= self.count:
+            raise IndexError('only {} samples held'.format(self.count))
+        pos = self._position(age)
+        offset = pos * self.width
+        return (self.times[pos],
+                None if self.uptimes[pos] == MISSING else self.uptimes[pos],
+                [None if value == MISSING else value
+                 for value in self.values[offset:offset + self.width]])
+
+    def samples(self):
+        'Return all the held samples, oldest first.'
+        return [self.sample(age) for age in range(self.count - 1, -1, -1)]
+
+    def rates(self, widths):
+        '''
+        Return the per-second rate of each counter between the two newest samples,
+        in the same order as the counters, using 'widths' to handle counter wraps.
+        A rate is None if there aren't two samples, either sample is missing that counter,
+        or sysUpTime went backwards, meaning that the agent restarted and reset its counters.
+        If either sample is missing sysUpTime, a wrap can't be told apart from a reset,
+        so counters that went backwards get no rate either.
+        '''
+        if self.count < 2:
+            return [None] * self.width
+        (newtime, newuptime, newvalues) = self.sample(0)
+        (oldtime, olduptime, oldvalues) = self.sample(1)
+        uptimes = newuptime is not None and olduptime is not None
+        if (uptimes and newuptime < olduptime) or newtime <= oldtime:
+            return [None] * self.width
+        # Prefer the agent's own clock, which isn't affected by network delay.
+        if uptimes and newuptime > olduptime:
+            interval = (newuptime - olduptime) / 100.0
+        else:
+            interval = newtime - oldtime
+        result = []
+        for (new, old, bits) in zip(newvalues, oldvalues, widths):
+            if new is None or old is None:
+                result.append(None)
+            elif new >= old:
+                result.append((new - old) / interval)
+            elif not uptimes:
+                result.append(None)
+            else:
+                # The counter wrapped around
+                result.append((new + 2 ** bits - old) / interval)
+        return result
+
+
+class CounterPoller:
+    "Polls interface counters on a device that's already been through discovery"
+
+    def __init__(self, device, counters=None, max_oids_per_pdu=48, history=60):
+        '''
+        - device: a Mib2 (or subclass) object. Its interface list is fetched if necessary.
+        - counters: list of counter names from COUNTERS. Defaults to all of them.
+        - max_oids_per_pdu: the largest number of OIDs to request in a single GET.
+          Reduced automatically if the agent can't fit the response into a PDU,
+          and raised again, up to this value, once polls succeed at the reduced size.
+        - history: number of samples to keep per interface.
+        '''
+        self.device = device
+        self.logger = device.logger
+        self.counters = list(counters or COUNTERS.keys())
+        self.widths = [COUNTERS[name][1] for name in self.counters]
+        self.max_oids_per_pdu = max_oids_per_pdu
+        self._pdu_ceiling = max_oids_per_pdu
+        self._clean_polls = 0   # Consecutive polls without tooBig
+        interfaces = device.interfaces() or []
+        self.ifindexes = [iface.ifIndex for iface in interfaces]
+        self.buffers = OrderedDict((ifindex, RingBuffer(history, len(self.counters)))
+                                   for ifindex in self.ifindexes)
+        # Precompute the request OIDs, and where each response value belongs,
+        # so each poll does no string formatting.
+        self._oids = []
+        self._slots = []
+        for (ifpos, ifindex) in enumerate(self.ifindexes):
+            for (cpos, name) in enumerate(self.counters):
+                self._oids.append('{}.{}'.format(COUNTERS[name][0], ifindex))
+                self._slots.append((ifpos, cpos))
+
+    def _get(self, oids):
+        'Fetch a list of OIDs, splitting it into as many GETs as the agent requires.'
+        result = []
+        start = 0
+        reduced = False
+        while start < len(oids):
+            batch = oids[start:start + self.max_oids_per_pdu]
+            try:
+                result.extend(snmp_get_many(self.device.engine,
+                                            self.device.auth,
+                                            self.device.target,
+                                            batch,
+                                            self.logger))
+            except SnmpTooBig:
+                if self.max_oids_per_pdu == 1:
+                    raise
+                self.max_oids_per_pdu = max(1, self.max_oids_per_pdu // 2)
+                reduced = True
+                self.logger.debug('Agent reported tooBig; reducing to %s OIDs per GET',
+                                  self.max_oids_per_pdu)
+                continue
+            start += len(batch)
+        self._clean_polls = 0 if reduced else self._clean_polls + 1
+        if self._clean_polls >= GROW_AFTER and self.max_oids_per_pdu < self._pdu_ceiling:
+            self.max_oids_per_pdu = min(self.max_oids_per_pdu * 2, self._pdu_ceiling)
+            self._clean_polls = 0
+            self.logger.debug('Raising to %s OIDs per GET', self.max_oids_per_pdu)
+        return result
+
+    def poll(self):
+        '''
+        Fetch the current value of every counter on every interface,
+        and add it to the history. Return the local timestamp of the sample.
+        '''
+        timestamp = time.time()
+        response = self._get([SYS_UPTIME] + self._oids)
+        uptime = _counter_value(response[0].value)
+        rows = [[MISSING] * len(self.counters) for _ in self.ifindexes]
+        for ((ifpos, cpos), datum) in zip(self._slots, response[1:]):
+            rows[ifpos][cpos] = _counter_value(datum.value)
+        for (buf, row) in zip(self.buffers.values(), rows):
+            buf.append(timestamp, uptime, row)
+        return timestamp
+
+    def rates(self, ifindex):
+        '''
+        Return a dict of per-second rates between the two most recent polls for one interface,
+        keyed by counter name. See RingBuffer.rates for when a rate is None.
+        '''
+        return dict(zip(self.counters, self.buffers[ifindex].rates(self.widths)))
+
+    def all_rates(self):
+        'Return the output of rates() for every interface, keyed by ifIndex.'
+        return {ifindex: self.rates(ifindex) for ifindex in self.ifindexes}
+
+    def samples(self, ifindex):
+        '''
+        Return the history for one interface, oldest first,
+        as a list of (timestamp, {counter name: value}) tuples.
+        '''
+        return [(timestamp, dict(zip(self.counters, values)))
+                for (timestamp, _, values) in self.buffers[ifindex].samples()]
+
+
+def poll_devices(pollers, logger, workers=16):
+    '''
+    Run poll() on a list of CounterPoller objects, with up to 'workers' devices at once.
+    Each device has its own SNMP engine, so they can safely be polled in parallel.
+    Failures are logged, and don't stop the other devices being polled.
+    Return the number of devices that were polled successfully.
+    '''
+    succeeded = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(poller.poll): poller for poller in pollers}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+                succeeded += 1
+            except (RuntimeError, ValueError) as err:
+                logger.error('Failed to poll %s: %s',
+                             futures[future].device.target.transportAddr[0], err)
+    return succeeded
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Persistent record of which SNMP community worked for each host.
+
+When several candidate communities are supplied, device_discovery.create_device tries the
+one recorded here first, and only probes the others if it fails. The file holds community
+strings in the clear, so it's created readable only by its owner.
+"""
+
+# Built-in modules
+import json
+import os
+import threading
+
+
+class CredentialCache:
+    "JSON file mapping hostnames to the SNMP community that last worked for them"
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._lock = threading.Lock()
+        try:
+            with open(filepath, 'r') as infile:
+                self._communities = json.load(infile)
+        except FileNotFoundError:
+            self._communities = {}
+
+    def get(self, hostname):
+        'Return the community recorded for a host, or None.'
+        with self._lock:
+            return self._communities.get(hostname)
+
+    def set(self, hostname, community):
+        'Record the community that worked for a host, and save the file if it changed.'
+        with self._lock:
+            if self._communities.get(hostname) == community:
+                return
+            self._communities[hostname] = community
+            self._save()
+
+    def discard(self, hostname):
+        'Forget the community recorded for a host, e.g. because it no longer works.'
+        with self._lock:
+            if self._communities.pop(hostname, None) is not None:
+                self._save()
+
+    def _save(self):
+        'Write the file, replacing it atomically. Must be called with the lock held.'
+        tmppath = '{}.tmp'.format(self.filepath)
+        with open(os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as outfile:
+            json.dump(self._communities, outfile, indent=4, sort_keys=True)
+        os.replace(tmppath, self.filepath)
@@ -21,15 +21,16 @@ Perform discovery on an individual host, using SNMP version 2c
 # Third-party libraries
 import pysnmp.hlapi
 
+# Included batteries
+import concurrent.futures
+import time
+
 # From this package
 from netdescribe.utils import create_logger
-from netdescribe.snmp.snmp_functions import snmp_get, snmp_walk
-from netdescribe.snmp.class_brocade import Brocade
-from netdescribe.snmp.class_linux import Linux
+from netdescribe.snmp.snmp_functions import (snmp_get, snmp_walk, transport_target,
+                                             DeadlineExceeded)
 from netdescribe.snmp.class_mib2 import Mib2
-
-# Included modules
-import re
+from netdescribe.snmp.device_registry import get_registry
 
 
 # Functions to actually get the data
@@ -77,74 +78,167 @@ def get_inv_stack_table(stack):
     # Start at subinterface '0', because that's how SNMP identifies "no interface here."
     return data
 
-def create_device(hostname, logger, community, port):
+def _probe(hostname, logger, community, port, deadline):
     '''
-    Create and return an object representing the device to be discovered.
-    Choose the most appropriate class, according to its sysObjectID.
+    Try a single community against a device, by fetching its sysObjectID.
+    Return (engine, auth, target, sysObjectID). Raises RuntimeError on failure.
+    Each probe has its own engine, so that several can run at once.
     '''
-    logger.info('Creating a device')
     # Create SNMP engine
     snmpengine = pysnmp.hlapi.SnmpEngine()
     # Create auth creds
     snmpauth = pysnmp.hlapi.CommunityData(community, community)
     # Create transport target object
-    snmptarget = pysnmp.hlapi.UdpTransportTarget((hostname, port))
+    snmptarget = transport_target(hostname, port)
     # Get the sysObjectId for this device
+    object_id = snmp_get(snmpengine,
+                         snmpauth,
+                         snmptarget,
+                         'SNMPv2-MIB',
+                         'sysObjectID',
+                         logger,
+                         deadline=deadline)
+    logger.debug('sysObjectID: {}'.format(object_id))
+    return (snmpengine, snmpauth, snmptarget, object_id)
+
+def _probe_all(hostname, logger, communities, port, deadline):
+    '''
+    Try several communities against a device at once.
+    Return (community, (engine, auth, target, sysObjectID)) for the first one that answers,
+    or None if none of them do. Probes still outstanding at that point are left to finish
+    in the background, rather than waiting for them to time out.
+    Raises ValueError if 'communities' is empty.
+    '''
+    if not communities:
+        raise ValueError('No candidate communities to probe {} with'.format(hostname))
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(communities))
     try:
-        object_id = snmp_get(snmpengine,
-                             snmpauth,
-                             snmptarget,
-                             'SNMPv2-MIB',
-                             'sysObjectID',
-                             logger)
-        logger.debug('sysObjectID: {}'.format(object_id))
-    except RuntimeError as err:
-        logger.error('Error caught: %s', str(err))
-        return False
-    # Create and return the object itself
-    # Brocade
-    if re.match(".*1991.*", object_id):
-        logger.info('Detected Brocade, probably Ironware.')
-        return Brocade(snmptarget, snmpengine, snmpauth, logger, sysObjectID=object_id)
-    # Linux
-    # For other OSes running NetSNMP, see http://www.oidview.com/mibs/8072/NET-SNMP-TC.html
-    if re.match(".*8072.3.2.10", object_id):
-        logger.info('Detected Linux.')
-        return Linux(snmptarget, snmpengine, snmpauth, logger, sysObjectID=object_id)
-    # Junos
-    # For model specifics, see http://www.oidview.com/mibs/2636/JUNIPER-CHASSIS-DEFINES-MIB.html
-    # The Mib2 class works well enough for now, but will need replacing when Juniper-specific
-    # details are needed.
-    if re.match(".*2636.1.1.1.*", object_id):
-        logger.info('Detected Junos.')
-        return Mib2(snmptarget, snmpengine, snmpauth, logger, sysObjectID=object_id)
-    # Fall back to the default
-    logger.info('Unrecognised sysObjectID for %s is %s. Creating a MIB-2 object',
-                hostname, object_id)
-    return Mib2(snmptarget, snmpengine, snmpauth, logger, sysObjectID=object_id)
+        futures = {executor.submit(_probe, hostname, logger, community, port, deadline): community
+                   for community in communities}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                return (futures[future], future.result())
+            except RuntimeError as err:
+                logger.debug('Community rejected by %s: %s', hostname, err)
+        return None
+    finally:
+        executor.shutdown(wait=False)
 
-def explore_device(hostname, logger=None, community='public', port=161):
+def create_device(hostname, logger, community, port, deadline=None, credential_cache=None):
+    '''
+    Create and return an object representing the device to be discovered.
+    Choose the most appropriate class, according to its sysObjectID,
+    via the registry in netdescribe.snmp.device_registry.
+    'deadline' is an optional time.monotonic() value by which the fingerprint must be done.
+    'community' is either a single community string, or a list of candidates. If several are
+    supplied, they're probed concurrently and the first to get an answer is used, so a wrong
+    guess doesn't cost a full timeout. If a netdescribe.snmp.credentials.CredentialCache is
+    supplied, the community it records for this host is tried first on its own, and the one
+    that works is recorded in it.
+    Return False if no community gets an answer.
+    '''
+    logger.info('Creating a device')
+    communities = [community] if isinstance(community, str) else list(community)
+    cached = credential_cache.get(hostname) if credential_cache else None
+    probed = None
+    # Try the community that worked last time, if it's still a candidate
+    if cached in communities:
+        try:
+            probed = (cached, _probe(hostname, logger, cached, port, deadline))
+        except DeadlineExceeded as err:
+            # The time budget ran out; that says nothing about the community.
+            logger.error('Error caught: %s', str(err))
+            return False
+        except RuntimeError as err:
+            logger.warning('Cached community for %s no longer works: %s', hostname, err)
+            credential_cache.discard(hostname)
+            communities.remove(cached)
+    if probed is None:
+        if not communities:
+            logger.error('No other candidate communities to try for %s', hostname)
+            return False
+        if len(communities) == 1:
+            try:
+                probed = (communities[0], _probe(hostname, logger, communities[0], port, deadline))
+            except RuntimeError as err:
+                logger.error('Error caught: %s', str(err))
+                return False
+        else:
+            probed = _probe_all(hostname, logger, communities, port, deadline)
+            if probed is None:
+                logger.error('None of the %s candidate communities worked for %s',
+                             len(communities), hostname)
+                return False
+    (working, (snmpengine, snmpauth, snmptarget, object_id)) = probed
+    if credential_cache:
+        credential_cache.set(hostname, working)
+    # Create and return the object itself,
+    # choosing the class registered against the longest matching sysObjectID prefix.
+    device_class = get_registry(logger).lookup(object_id)
+    if device_class is Mib2:
+        logger.info('Unrecognised sysObjectID for %s is %s. Creating a MIB-2 object',
+                    hostname, object_id)
+    else:
+        logger.info('Detected %s.', device_class.__name__)
+    return device_class(snmptarget, snmpengine, snmpauth, logger, sysObjectID=object_id)
+
+def explore_device(hostname, logger=None, community='public', port=161, profiler=None,
+                   budget=None, table_budget=None, window=None, credential_cache=None,
+                   discovery_profile=None):
     '''
     Build up a picture of a device via SNMP queries.
     Return the results as a nest of dicts:
     - sysinfo: output of identify_host()
     - network: output of discover_host_networking()
+    If a netdescribe.profiling.DiscoveryProfiler is supplied, the cost of fingerprinting
+    the device and of each discovery phase is recorded in it.
+    - budget: the most seconds that discovery of this device may take, in total.
+    - table_budget: the most seconds that any one discovery phase may take.
+    When a budget runs out, the tables retrieved so far are kept, and the device's
+    discovery_status() records which phase ran out of time.
+    - window: the number of walks to have in flight against the device at once,
+      so that its tables are retrieved side by side. Defaults to the device class'
+      pipeline_window, which is 1 for Mib2: one walk at a time.
+    - community: a community string, or a list of candidates; see create_device.
+    - credential_cache: a netdescribe.snmp.credentials.CredentialCache, recording which
+      community works for each host.
+    - discovery_profile: the name of a profile in netdescribe.snmp.discovery_profiles.PROFILES,
+      e.g. 'names', or a DiscoveryProfile, limiting what's retrieved. Anything left out can
+      still be fetched later, via the device object's lazy attributes.
     '''
     # Ensure we have a logger
     if not logger:
         logger = create_logger()
     # Now get to work
     logger.info('Performing discovery on %s', hostname)
+    deadline = time.monotonic() + budget if budget is not None else None
     # Create an object to represent this device,
     # taking its SNMP capabilities into account
     try:
-        device = create_device(hostname, logger, community, port)
+        if profiler:
+            with profiler.phase('fingerprint'):
+                device = create_device(hostname, logger, community, port, deadline=deadline,
+                                       credential_cache=credential_cache)
+        else:
+            device = create_device(hostname, logger, community, port, deadline=deadline,
+                                   credential_cache=credential_cache)
         if device:
             # Perform discovery as appropriate to this device type
-            device.discover()
+            device.discover(profiler=profiler, deadline=deadline, table_budget=table_budget,
+                            window=window, profile=discovery_profile)
             # Return the device object, complete with its discovered data
             return device
         return False
     except RuntimeError as err:
         logger.error('Error caught: %s', str(err))
         return False
+
+def explore_entry(entry, logger=None, profiler=None, budget=None, table_budget=None,
+                  window=None, credential_cache=None, discovery_profile=None):
+    '''
+    Run explore_device against a netdescribe.inventory.InventoryEntry.
+    '''
+    return explore_device(entry.hostname, logger, community=entry.community, port=entry.port,
+                          profiler=profiler, budget=budget, table_budget=table_budget,
+                          window=window, credential_cache=credential_cache,
+                          discovery_profile=discovery_profile)
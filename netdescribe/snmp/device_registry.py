@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Registry of device classes, keyed by the sysObjectID prefixes they handle.
+
+Each device class declares its prefixes in the class attribute 'sys_object_id_prefixes'.
+Lookups walk a trie of OID arcs, and return the class registered against the longest
+matching prefix, so the cost of a lookup depends on the length of the OID and not on
+the number of registered classes.
+
+Third-party packages can add their own classes by declaring an entry point in the
+'netdescribe.device_classes' group, e.g. in setup.py:
+
+    entry_points={'netdescribe.device_classes': ['acme = acme_netdescribe:Acme']}
+"""
+
+# From this package
+from netdescribe.snmp.class_brocade import Brocade
+from netdescribe.snmp.class_junos import Junos
+from netdescribe.snmp.class_linux import Linux
+from netdescribe.snmp.class_mib2 import Mib2
+
+# Included batteries
+import logging
+
+
+ENTRY_POINT_GROUP = 'netdescribe.device_classes'
+
+# Textual prefixes that pysnmp may use when rendering an OID value,
+# mapped to their numeric equivalents.
+OID_PREFIXES = {
+    'SNMPv2-SMI::enterprises': '1.3.6.1.4.1',
+    'SNMPv2-SMI::mib-2': '1.3.6.1.2.1',
+    'SNMPv2-SMI::internet': '1.3.6.1',
+    'iso': '1',
+    }
+
+# Key under which a trie node stores the class registered at that point.
+# Arcs are always integers, so this can't collide with a child node.
+_CLASS_KEY = 'class'
+
+
+def oid_arcs(oid):
+    '''
+    Convert an OID in string form to a tuple of integer arcs.
+    Accepts both numeric OIDs ('1.3.6.1.4.1.8072.3.2.10', with or without a leading dot)
+    and the 'SNMPv2-SMI::enterprises.8072.3.2.10' form.
+    Raises ValueError if the OID can't be parsed.
+    '''
+    oid = oid.strip().lstrip('.')
+    for prefix, numeric in OID_PREFIXES.items():
+        if oid == prefix or oid.startswith(prefix + '.'):
+            oid = numeric + oid[len(prefix):]
+            break
+    return tuple(int(arc) for arc in oid.split('.'))
+
+
+class DeviceRegistry:
+    "Maps sysObjectID prefixes to device classes, with longest-prefix-match lookups"
+
+    def __init__(self, default=Mib2):
+        self.default = default
+        self._trie = {}
+
+    def register(self, device_class, prefixes=None):
+        '''
+        Register a device class against a list of sysObjectID prefixes.
+        If 'prefixes' isn't supplied, use the class' 'sys_object_id_prefixes' attribute.
+        A later registration for the same prefix replaces the earlier one.
+        '''
+        if prefixes is None:
+            prefixes = getattr(device_class, 'sys_object_id_prefixes', ())
+        for prefix in prefixes:
+            node = self._trie
+            for arc in oid_arcs(prefix):
+                node = node.setdefault(arc, {})
+            node[_CLASS_KEY] = device_class
+        return device_class
+
+    def lookup(self, object_id):
+        '''
+        Return the device class registered against the longest prefix of this sysObjectID,
+        or the default class if nothing matches.
+        '''
+        try:
+            arcs = oid_arcs(object_id)
+        except (AttributeError, ValueError):
+            return self.default
+        match = self.default
+        node = self._trie
+        for arc in arcs:
+            node = node.get(arc)
+            if node is None:
+                break
+            match = node.get(_CLASS_KEY, match)
+        return match
+
+    def load_entry_points(self, logger=None):
+        '''
+        Register the device classes advertised by installed packages
+        via the 'netdescribe.device_classes' entry-point group.
+        Classes that fail to load are logged and skipped.
+        '''
+        logger = logger or logging.getLogger('netdescribe')
+        for entry_point in _iter_entry_points():
+            try:
+                device_class = entry_point.load()
+            except Exception as err:    # pylint: disable=broad-except
+                logger.error('Failed to load device class %s: %s', entry_point.name, err)
+                continue
+            logger.debug('Registering device class %s from entry point %s',
+                         device_class.__name__, entry_point.name)
+            self.register(device_class)
+
+
+def _iter_entry_points():
+    'Return the entry points in our group, using whichever API this Python provides.'
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return []
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+    entry_points = metadata.entry_points()
+    # The selection API arrived in Python 3.10; earlier versions return a dict.
+    if hasattr(entry_points, 'select'):
+        return list(entry_points.select(group=ENTRY_POINT_GROUP))
+    return list(entry_points.get(ENTRY_POINT_GROUP, []))
+
+
+def default_registry(logger=None):
+    '''
+    Return a registry containing the built-in device classes,
+    plus any advertised via entry points.
+    '''
+    registry = DeviceRegistry()
+    for device_class in (Brocade, Linux, Junos):
+        registry.register(device_class)
+    registry.load_entry_points(logger)
+    return registry
+
+
+# Module-level registry, created on first use so that entry points are only scanned once.
+_REGISTRY = None
+
+def get_registry(logger=None):
+    'Return the shared registry, creating it if necessary.'
+    global _REGISTRY    # pylint: disable=global-statement
+    if _REGISTRY is None:
+        _REGISTRY = default_registry(logger)
+    return _REGISTRY
+
+def register(device_class, prefixes=None):
+    '''
+    Register a device class with the shared registry.
+    Usable as a class decorator.
+    '''
+    return get_registry().register(device_class, prefixes)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Discovery profiles: named subsets of what Mib2.discover() retrieves.
+
+Lightweight queries, e.g. "what are this device's interfaces called?", don't need every
+table, so a profile limits discovery to some of the phases, some of the system scalars and
+some of the IF-MIB columns. Anything left out can still be fetched afterwards, through the
+device's lazy attributes, e.g. device.sys_location or device.addresses.
+"""
+
+# Built-in modules
+from collections import namedtuple
+
+
+DiscoveryProfile = namedtuple('discoveryProfile', [
+    'phases',       # Discovery phases to run; None for all of the device class' phases
+    'system',       # SNMPv2-MIB scalars fetched by 'identify'; None for all of them
+    'if_columns',   # IF-MIB columns walked by 'interfaces'; None for all of the class' columns
+    ])
+
+PROFILES = {
+    # Everything: the default
+    'full': DiscoveryProfile(phases=None, system=None, if_columns=None),
+    # Just the system group
+    'system': DiscoveryProfile(phases=['identify'], system=None, if_columns=[]),
+    # The device's name, and the names of its interfaces
+    'names': DiscoveryProfile(phases=['identify', 'interfaces'],
+                              system=['sysName'],
+                              if_columns=['ifName']),
+    # IP addresses, with the names of the interfaces they're configured on
+    'addresses': DiscoveryProfile(phases=['interfaces', 'ip_addrs', 'ip_addresses'],
+                                  system=[],
+                                  if_columns=['ifName']),
+    }
+
+
+def get_profile(profile):
+    '''
+    Return the DiscoveryProfile for a profile name, or the profile itself if it's
+    already a DiscoveryProfile. None means the 'full' profile.
+    Raises ValueError for unknown names.
+    '''
+    if profile is None:
+        return PROFILES['full']
+    if isinstance(profile, DiscoveryProfile):
+        return profile
+    try:
+        return PROFILES[profile]
+    except KeyError:
+        raise ValueError('Unknown discovery profile {}; choose from {}'.format(
+            profile, ', '.join(sorted(PROFILES))))
@@ -16,27 +16,105 @@
 
 """
 General SNMP functions
+
+All SNMP traffic goes through the functions in this module, which makes it the place to
+record it. start_recording() captures every request and response, with its timing,
+to a file; start_replay() then serves those responses from the file instead of the network,
+either as fast as possible or at the recorded speed (optionally accelerated).
+This allows discovery of a real device to be reproduced and profiled offline.
 """
 
 # Third-party libraries
 import pysnmp.hlapi
+import pysnmp.proto.rfc1905
 
 # Built-in modules
-from collections import namedtuple
+from collections import deque, namedtuple
+import contextlib
+import copy
+import json
+import math
 import re
+import threading
+import time
 
 
 # Data structures
 SnmpDatum = namedtuple('snmpDatum', ['oid', 'value'])
 
+# A single cell from a multi-column walk: the position of its column in the request,
+# the row index as a tuple of integer arcs, and the value as a string.
+SnmpCell = namedtuple('snmpCell', ['column', 'oid', 'value'])
+
+# Stands in for UdpTransportTarget during replay, so that no name resolution happens.
+ReplayTarget = namedtuple('replayTarget', ['transportAddr'])
+
+
+# Exceptions
+
+class SnmpTooBig(RuntimeError):
+    '''
+    The agent couldn't fit its response into a single PDU.
+    Subclasses RuntimeError, so existing error handling still catches it.
+    '''
+    pass
+
+class DeadlineExceeded(RuntimeError):
+    '''
+    The time budget for an operation ran out before it completed.
+    Subclasses RuntimeError, so existing error handling still catches it.
+    '''
+    pass
+
 
 # Basic functions
 
-def snmp_get(engine, auth, target, mib, attr, logger):
+def check_deadline(deadline, logger, what='SNMP operation'):
+    '''
+    Raise DeadlineExceeded if 'deadline', a time.monotonic() value, has passed.
+    A deadline of None never passes.
+    '''
+    if deadline is not None and time.monotonic() >= deadline:
+        logger.warning('Deadline exceeded during %s', what)
+        raise DeadlineExceeded('Deadline exceeded during {}'.format(what))
+
+def bounded_target(target, deadline):
+    '''
+    Return a transport target whose timeout and retries fit in the time left before
+    'deadline', so that a request already in flight can't overrun it by the target's full
+    timeout multiplied by its retries. The timeout is rounded up to whole seconds, so that
+    a request that times out does so just after the deadline, and is reported as
+    DeadlineExceeded. Rounding also keeps the number of distinct timeout and retries pairs
+    small: pysnmp adds an entry to the engine's configuration for each one it sees.
+    Return the target itself if there's no deadline, if it already fits, or if it
+    has no timeout to adjust, as during replay.
+    '''
+    if deadline is None or not hasattr(target, 'timeout'):
+        return target
+    remaining = max(deadline - time.monotonic(), 0.01)
+    if target.timeout * (target.retries + 1) <= remaining:
+        return target
+    bounded = copy.copy(target)
+    if remaining >= target.timeout:
+        bounded.retries = int(remaining // target.timeout) - 1
+    else:
+        bounded.retries = 0
+        bounded.timeout = math.ceil(remaining)
+    return bounded
+
+def snmp_get(engine, auth, target, mib, attr, logger, deadline=None):
     '''
     Perform an SNMP GET for a single OID or scalar attribute.
     Return only the value.
+    If 'deadline' (a time.monotonic() value) has already passed, raise DeadlineExceeded.
     '''
+    check_deadline(deadline, logger, '{}::{}'.format(mib, attr))
+    return _session_call('get', target, [mib, attr], logger,
+                         _snmp_get, engine, auth, bounded_target(target, deadline), mib, attr,
+                         logger, deadline)
+
+def _snmp_get(engine, auth, target, mib, attr, logger, deadline=None):
+    'Implementation of snmp_get, bypassing any recording or replay session.'
     logger.debug('Getting %s::%s from %s', mib, attr, target.transportAddr[0])
     # Use pysnmp to retrieve the data
     obj = pysnmp.hlapi.ObjectIdentity(mib, attr, 0)
@@ -46,6 +124,7 @@ def snmp_get(engine, auth, target, mib, attr, logger):
     # Handle the responses
     returnval = None
     if error_indication:
+        check_deadline(deadline, logger, '{}::{}'.format(mib, attr))
         logger.error(error_indication)
         raise RuntimeError(error_indication)
     elif error_status:
@@ -57,11 +136,64 @@ def snmp_get(engine, auth, target, mib, attr, logger):
         returnval = var_binds[0][1].prettyPrint()
     return returnval
 
-def snmp_walk(engine, auth, target, mib, attr, logger):
+def snmp_get_many(engine, auth, target, oids, logger, deadline=None):
+    '''
+    Perform a single SNMP GET for a list of numeric OIDs, e.g. '1.3.6.1.2.1.31.1.1.1.6.3'.
+    Skips MIB lookups, which keeps it cheap enough for high-frequency polling.
+    Return a list of SnmpDatum namedtuples in the same order as the request,
+    where the value is the raw pysnmp object, or None if the agent has no such object.
+    Raises SnmpTooBig if the response wouldn't fit in a PDU, so the caller can retry with
+    fewer OIDs per request, and RuntimeError for any other error.
+    During replay, values are served as their string representations.
+    If 'deadline' (a time.monotonic() value) has already passed, raise DeadlineExceeded.
+    '''
+    check_deadline(deadline, logger, 'GET of {} OIDs'.format(len(oids)))
+    return _session_call('get_many', target, list(oids), logger,
+                         _snmp_get_many, engine, auth, bounded_target(target, deadline), oids,
+                         logger, deadline)
+
+def _snmp_get_many(engine, auth, target, oids, logger, deadline=None):
+    'Implementation of snmp_get_many, bypassing any recording or replay session.'
+    logger.debug('Getting %s OIDs from %s', len(oids), target.transportAddr[0])
+    cmd = pysnmp.hlapi.getCmd(engine,
+                              auth,
+                              target,
+                              pysnmp.hlapi.ContextData(),
+                              *[pysnmp.hlapi.ObjectType(pysnmp.hlapi.ObjectIdentity(oid))
+                                for oid in oids],
+                              lookupMib=False)
+    error_indication, error_status, error_index, var_binds = next(cmd)
+    if error_indication:
+        check_deadline(deadline, logger, 'GET of {} OIDs'.format(len(oids)))
+        logger.error(error_indication)
+        raise RuntimeError(error_indication)
+    elif error_status:
+        if error_status.prettyPrint() == 'tooBig':
+            raise SnmpTooBig('tooBig')
+        logger.error('%s at %s' % (error_status.prettyPrint(),
+                                   error_index and var_binds[int(error_index) - 1][0] or '?'))
+        raise RuntimeError(error_status.prettyPrint())
+    return [SnmpDatum(oid=str(var[0]),
+                      value=None if isinstance(var[1], (pysnmp.proto.rfc1905.NoSuchObject,
+                                                        pysnmp.proto.rfc1905.NoSuchInstance,
+                                                        pysnmp.proto.rfc1905.EndOfMibView))
+                      else var[1])
+            for var in var_binds]
+
+def snmp_walk(engine, auth, target, mib, attr, logger, deadline=None):
     '''
     Walk an SNMP OID.
     Return a list of SnmpDatum namedtuples.
+    If 'deadline' (a time.monotonic() value) passes before the walk completes,
+    raise DeadlineExceeded.
     '''
+    check_deadline(deadline, logger, '{}::{}'.format(mib, attr))
+    return _session_call('walk', target, [mib, attr], logger,
+                         _snmp_walk, engine, auth, bounded_target(target, deadline), mib, attr,
+                         logger, deadline)
+
+def _snmp_walk(engine, auth, target, mib, attr, logger, deadline=None):
+    'Implementation of snmp_walk, bypassing any recording or replay session.'
     logger.debug('Walking %s::%s on %s', mib, attr, target.transportAddr[0])
     # Build and execute the command
     obj = pysnmp.hlapi.ObjectIdentity(mib, attr)
@@ -74,6 +206,7 @@ def snmp_walk(engine, auth, target, mib, attr, logger):
                                lexicographicMode=False)
     returnval = []
     for (error_indication, error_status, error_index, var_binds) in cmd:
+        check_deadline(deadline, logger, '{}::{}'.format(mib, attr))
         # Handle the responses
         if error_indication:
             logger.error(error_indication)
@@ -96,3 +229,327 @@ def snmp_walk(engine, auth, target, mib, attr, logger):
                 logger.debug('%s = %s', index, val)
                 returnval.append(SnmpDatum(oid=index, value=val))
     return returnval
+
+def snmp_walk_oid(engine, auth, target, oid, logger, deadline=None):
+    '''
+    Walk a numeric OID, e.g. the column '1.3.6.1.2.1.4.34.1.3', without MIB lookups.
+    Return a list of SnmpDatum namedtuples, whose 'oid' is the index within the column
+    as a tuple of integer arcs, and whose value is a string.
+    Skipping the MIB lookups makes this much cheaper than snmp_walk for large tables,
+    and hands callers an index they can decode without parsing strings.
+    If 'deadline' (a time.monotonic() value) passes before the walk completes,
+    raise DeadlineExceeded.
+    '''
+    check_deadline(deadline, logger, oid)
+    return _session_call('walk_oid', target, [oid], logger,
+                         _snmp_walk_oid, engine, auth, bounded_target(target, deadline), oid,
+                         logger, deadline)
+
+def _snmp_walk_oid(engine, auth, target, oid, logger, deadline=None):
+    'Implementation of snmp_walk_oid, bypassing any recording or replay session.'
+    logger.debug('Walking %s on %s', oid, target.transportAddr[0])
+    base = len(oid.split('.'))
+    cmd = pysnmp.hlapi.nextCmd(engine,
+                               auth,
+                               target,
+                               pysnmp.hlapi.ContextData(),
+                               pysnmp.hlapi.ObjectType(pysnmp.hlapi.ObjectIdentity(oid)),
+                               lexicographicMode=False,
+                               lookupMib=False)
+    returnval = []
+    for (error_indication, error_status, error_index, var_binds) in cmd:
+        check_deadline(deadline, logger, oid)
+        if error_indication:
+            logger.error(error_indication)
+        elif error_status:
+            logger.error('%s at %s',
+                         error_status.prettyPrint(),
+                         error_index and var_binds[int(error_index) - 1][0] or '?')
+        else:
+            for var in var_binds:
+                returnval.append(SnmpDatum(oid=tuple(var[0])[base:], value=var[1].prettyPrint()))
+    return returnval
+
+def snmp_walk_columns(engine, auth, target, oids, logger, max_repetitions=25, deadline=None):
+    '''
+    Walk several numeric column OIDs of the same table together, using GETBULK,
+    and without MIB lookups.
+    This is a generator: it yields SnmpCell namedtuples as the responses arrive, so that
+    very large tables can be processed without holding them in memory, and the walk
+    stops as soon as the caller stops iterating.
+    Raises RuntimeError if the agent returns an error part-way through,
+    and DeadlineExceeded if 'deadline' (a time.monotonic() value) passes first.
+    '''
+    check_deadline(deadline, logger, 'bulk walk')
+    return _session_iter('walk_columns', target, list(oids), logger,
+                         _snmp_walk_columns, engine, auth, bounded_target(target, deadline), oids,
+                         logger, max_repetitions, deadline)
+
+def _snmp_walk_columns(engine, auth, target, oids, logger, max_repetitions, deadline=None):
+    'Implementation of snmp_walk_columns, bypassing any recording or replay session.'
+    logger.debug('Bulk-walking %s on %s', ', '.join(oids), target.transportAddr[0])
+    bases = [tuple(int(arc) for arc in oid.split('.')) for oid in oids]
+    cmd = pysnmp.hlapi.bulkCmd(engine,
+                               auth,
+                               target,
+                               pysnmp.hlapi.ContextData(),
+                               0,
+                               max_repetitions,
+                               *[pysnmp.hlapi.ObjectType(pysnmp.hlapi.ObjectIdentity(oid))
+                                 for oid in oids],
+                               lexicographicMode=False,
+                               lookupMib=False)
+    for (error_indication, error_status, error_index, var_binds) in cmd:
+        check_deadline(deadline, logger, 'bulk walk')
+        if error_indication:
+            logger.error(error_indication)
+            raise RuntimeError(error_indication)
+        elif error_status:
+            logger.error('%s at %s',
+                         error_status.prettyPrint(),
+                         error_index and var_binds[int(error_index) - 1][0] or '?')
+            raise RuntimeError(error_status.prettyPrint())
+        for (column, var) in enumerate(var_binds):
+            name = tuple(var[0])
+            base = bases[column]
+            # Columns that end before the others keep returning whatever follows them,
+            # until every column has left its subtree; skip those.
+            if name[:len(base)] != base or \
+                    isinstance(var[1], pysnmp.proto.rfc1905.EndOfMibView):
+                continue
+            yield SnmpCell(column=column, oid=name[len(base):], value=var[1].prettyPrint())
+
+
+# Transport targets
+
+def transport_target(hostname, port=161, **kwargs):
+    '''
+    Create the transport target for a device.
+    Keyword arguments, e.g. 'timeout' and 'retries', are passed to UdpTransportTarget.
+    During replay, return a ReplayTarget with the address recorded for this hostname,
+    so that replay works without name resolution or network access.
+    '''
+    session = _SESSION
+    if session and session.replaying:
+        return ReplayTarget(transportAddr=session.address_for(hostname, port))
+    target = pysnmp.hlapi.UdpTransportTarget((hostname, port), **kwargs)
+    if session:
+        session.record_target(hostname, port, target.transportAddr)
+    return target
+
+
+# Recording and replay
+
+class SnmpRecorder:
+    '''
+    Writes each SNMP request and its outcome to a file, one JSON object per line:
+    - {"op": "target", "hostname": ..., "port": ..., "address": [...]}
+    - {"op": "get" | "walk" | "walk_oid" | "walk_columns" | "get_many",
+       "address": [...], "request": [...], "elapsed": <seconds>, "result": ...,
+       "error": <message or null>, "tooBig": <bool>}
+    '''
+    replaying = False
+
+    def __init__(self, filepath):
+        self._outfile = open(filepath, 'w')
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        'Append a single record to the file.'
+        line = json.dumps(record, sort_keys=True)
+        with self._lock:
+            self._outfile.write(line + '\n')
+
+    def record_target(self, hostname, port, address):
+        'Note the address a hostname resolved to, so replay can find it again.'
+        self._write({'op': 'target', 'hostname': hostname, 'port': port,
+                     'address': list(address)})
+
+    def call(self, operation, target, request, logger, func, *args):
+        'Perform a live SNMP operation, and record its result or error.'
+        record = {'op': operation, 'address': list(target.transportAddr), 'request': request,
+                  'result': None, 'error': None, 'tooBig': False}
+        start = time.perf_counter()
+        try:
+            result = func(*args)
+        except RuntimeError as err:
+            record['elapsed'] = time.perf_counter() - start
+            record['error'] = str(err)
+            record['tooBig'] = isinstance(err, SnmpTooBig)
+            self._write(record)
+            raise
+        record['elapsed'] = time.perf_counter() - start
+        if operation == 'get':
+            record['result'] = result
+        elif operation == 'walk':
+            record['result'] = [list(datum) for datum in result]
+        elif operation == 'walk_oid':
+            record['result'] = [[list(datum.oid), datum.value] for datum in result]
+        else:
+            record['result'] = [[datum.oid,
+                                 None if datum.value is None else datum.value.prettyPrint()]
+                                for datum in result]
+        self._write(record)
+        return result
+
+    def iterate(self, operation, target, request, logger, func, *args):
+        '''
+        Perform a live streaming SNMP operation, passing its results through as they arrive,
+        and record them once it finishes or the caller stops iterating.
+        '''
+        record = {'op': operation, 'address': list(target.transportAddr), 'request': request,
+                  'result': [], 'error': None, 'tooBig': False}
+        start = time.perf_counter()
+        try:
+            for cell in func(*args):
+                record['result'].append([cell.column, list(cell.oid), cell.value])
+                yield cell
+        except RuntimeError as err:
+            record['error'] = str(err)
+            raise
+        finally:
+            record['elapsed'] = time.perf_counter() - start
+            self._write(record)
+
+    def close(self):
+        'Flush and close the recording.'
+        with self._lock:
+            self._outfile.close()
+
+
+class SnmpReplayer:
+    '''
+    Serves SNMP responses from a file written by SnmpRecorder.
+    Repeated identical requests are answered with successive recorded responses;
+    once those run out, the last one is repeated.
+    - speed: None to answer immediately; otherwise, wait for the recorded time divided by
+      this factor, i.e. 1.0 for the recorded speed, 10.0 for ten times faster.
+    '''
+    replaying = True
+
+    def __init__(self, filepath, speed=None):
+        self.speed = speed
+        self._addresses = {}
+        self._responses = {}
+        self._lock = threading.Lock()
+        with open(filepath, 'r') as infile:
+            for line in infile:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record['op'] == 'target':
+                    self._addresses[(record['hostname'], record['port'])] = \
+                        tuple(record['address'])
+                else:
+                    self._responses.setdefault(self._key(record['op'],
+                                                         record['address'],
+                                                         record['request']),
+                                               deque()).append(record)
+
+    @staticmethod
+    def _key(operation, address, request):
+        'Index for looking up recorded responses.'
+        return (operation, tuple(address), json.dumps(request))
+
+    def address_for(self, hostname, port):
+        'Return the address recorded for this hostname, or the hostname itself.'
+        return self._addresses.get((hostname, port), (hostname, port))
+
+    def _next_record(self, operation, target, request, logger):
+        'Return the next recorded response for this request, waiting if so configured.'
+        key = self._key(operation, target.transportAddr, request)
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                message = 'No recorded response for {} {} on {}'.format(
+                    operation, request, target.transportAddr[0])
+                logger.error(message)
+                raise RuntimeError(message)
+            record = responses.popleft() if len(responses) > 1 else responses[0]
+        if self.speed:
+            time.sleep(record['elapsed'] / self.speed)
+        return record
+
+    def iterate(self, operation, target, request, logger, func, *args):
+        'Yield the recorded results for this streaming request, then any recorded error.'
+        record = self._next_record(operation, target, request, logger)
+        for (column, oid, value) in record['result']:
+            yield SnmpCell(column=column, oid=tuple(oid), value=value)
+        if record['error'] is not None:
+            logger.error(record['error'])
+            raise RuntimeError(record['error'])
+
+    def call(self, operation, target, request, logger, func, *args):
+        'Return the recorded result for this request, or raise the recorded error.'
+        record = self._next_record(operation, target, request, logger)
+        if record['error'] is not None:
+            if record['tooBig']:
+                raise SnmpTooBig(record['error'])
+            logger.error(record['error'])
+            raise RuntimeError(record['error'])
+        if operation == 'get':
+            return record['result']
+        if operation == 'walk_oid':
+            return [SnmpDatum(oid=tuple(oid), value=value) for (oid, value) in record['result']]
+        return [SnmpDatum(oid=oid, value=value) for (oid, value) in record['result']]
+
+
+# The active recording or replay session, if any.
+# This is process-wide, so that it covers every device and thread without
+# having to be passed through each layer of discovery.
+_SESSION = None
+
+def _session_call(operation, target, request, logger, func, *args):
+    'Dispatch an SNMP operation to the active session, or straight to the network.'
+    session = _SESSION
+    if session is None:
+        return func(*args)
+    return session.call(operation, target, request, logger, func, *args)
+
+def _session_iter(operation, target, request, logger, func, *args):
+    'Dispatch a streaming SNMP operation to the active session, or straight to the network.'
+    session = _SESSION
+    if session is None:
+        return func(*args)
+    return session.iterate(operation, target, request, logger, func, *args)
+
+def start_recording(filepath):
+    'Start recording all SNMP traffic to a file.'
+    global _SESSION     # pylint: disable=global-statement
+    stop_session()
+    _SESSION = SnmpRecorder(filepath)
+
+def start_replay(filepath, speed=None):
+    '''
+    Serve all SNMP requests from a recording, instead of the network.
+    See SnmpReplayer for the meaning of 'speed'.
+    '''
+    global _SESSION     # pylint: disable=global-statement
+    stop_session()
+    _SESSION = SnmpReplayer(filepath, speed)
+
+def stop_session():
+    'End any recording or replay session, and return to using the network.'
+    global _SESSION     # pylint: disable=global-statement
+    session = _SESSION
+    _SESSION = None
+    if isinstance(session, SnmpRecorder):
+        session.close()
+
+@contextlib.contextmanager
+def recording(filepath):
+    'Context manager for start_recording.'
+    start_recording(filepath)
+    try:
+        yield
+    finally:
+        stop_session()
+
+@contextlib.contextmanager
+def replaying(filepath, speed=None):
+    'Context manager for start_replay.'
+    start_replay(filepath, speed)
+    try:
+        yield
+    finally:
+        stop_session()
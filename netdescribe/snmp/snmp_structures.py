@@ -54,3 +54,11 @@ IpAddr = namedtuple('ipAddr', [
     'ipAdEntAddr',      # The actual IP address
     'ipAdEntNetMask'    # The address' netmask
     ])
+
+Neighbour = namedtuple('neighbour', [
+    'protocol',         # Discovery protocol that reported the neighbour: lldp | cdp
+    'localPort',        # Name or ID of the local port on which the neighbour was seen
+    'remoteName',       # The neighbour's system name or device ID
+    'remotePort',       # The neighbour's port ID
+    'remoteAddress'     # The neighbour's management address, as a string; None if not reported
+    ])
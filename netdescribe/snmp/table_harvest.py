@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+
+#   Copyright [2018] [James Fleming <james@electronic-quill.net]
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+"""
+Disk-backed harvesting of very large tables: ARP/ND, bridge forwarding and routing.
+
+On core devices these tables can run to hundreds of thousands of rows, so rather than
+accumulating them in lists and dicts as Mib2 does for interfaces and addresses,
+the harvester streams rows from a bulk walk straight into an SQLite database in batches,
+and the stored rows are read back through iterators.
+A harvest can be limited by row count and by time; if it stops early, it's marked as
+incomplete in the database, along with the reason.
+Rows are written to a staging table, which only replaces the stored table at the end;
+an incomplete harvest is discarded if the store already holds a complete one, so that
+a failed harvest doesn't destroy the last good copy.
+"""
+
+# Local modules
+from netdescribe.snmp.addresses import INET_ADDRESS_TYPES, arcs_to_int
+from netdescribe.snmp.snmp_functions import DeadlineExceeded, snmp_walk_columns
+
+# Built-in modules
+from collections import namedtuple
+import ipaddress
+import sqlite3
+import time
+
+
+TableSpec = namedtuple('tableSpec', [
+    'entry',        # Numeric OID of the table's entry
+    'columns',      # List of (column name, column number) tuples to walk
+    'keys',         # Names of the values decoded from each row's index
+    'decode',       # Function turning an index tuple into a tuple of those values
+    ])
+
+HarvestResult = namedtuple('harvestResult', [
+    'table',        # Name of the table
+    'rows',         # Number of rows stored
+    'complete',     # True if the whole table was walked
+    'reason',       # Why the harvest stopped early: None, 'max_rows', 'max_seconds' or an error
+    'elapsed',      # Seconds taken
+    ])
+
+
+# Index decoders
+
+def _inet_address(arcs, start):
+    '''
+    Decode a length-prefixed InetAddressType/InetAddress pair from an index.
+    Return (address as a string, or None for the 'unknown' type, position after it).
+    '''
+    (addrtype, length) = (arcs[start], arcs[start + 1])
+    end = start + 2 + length
+    if addrtype not in INET_ADDRESS_TYPES or length == 0:
+        return (None, end)
+    (_, version, octets) = INET_ADDRESS_TYPES[addrtype]
+    value = arcs_to_int(arcs[start + 2:start + 2 + octets])
+    if version == 4:
+        return (str(ipaddress.IPv4Address(value)), end)
+    return (str(ipaddress.IPv6Address(value)), end)
+
+def _decode_net_to_physical(arcs):
+    'ipNetToPhysicalTable: ipNetToPhysicalIfIndex, ipNetToPhysicalNetAddress'
+    return (arcs[0], _inet_address(arcs, 1)[0])
+
+def _decode_fdb(arcs):
+    'dot1qTpFdbTable: dot1qFdbId, dot1qTpFdbAddress'
+    return (arcs[0], ':'.join('{:02x}'.format(octet) for octet in arcs[1:7]))
+
+def _decode_route(arcs):
+    '''
+    inetCidrRouteTable: inetCidrRouteDest, inetCidrRoutePfxLen, inetCidrRouteNextHop.
+    The index also includes inetCidrRoutePolicy, a length-prefixed OID, which is skipped.
+    '''
+    (dest, pos) = _inet_address(arcs, 0)
+    pfxlen = arcs[pos]
+    pos += 1
+    pos += 1 + arcs[pos]    # inetCidrRoutePolicy
+    (nexthop, _) = _inet_address(arcs, pos)
+    return (dest, pfxlen, nexthop)
+
+
+TABLES = {
+    'ipNetToPhysicalTable': TableSpec(
+        entry='1.3.6.1.2.1.4.35.1',
+        columns=[('ipNetToPhysicalPhysAddress', 4),
+                 ('ipNetToPhysicalType', 6),
+                 ('ipNetToPhysicalState', 7)],
+        keys=['ifIndex', 'address'],
+        decode=_decode_net_to_physical),
+    'dot1qTpFdbTable': TableSpec(
+        entry='1.3.6.1.2.1.17.7.1.2.2.1',
+        columns=[('dot1qTpFdbPort', 2),
+                 ('dot1qTpFdbStatus', 3)],
+        keys=['fdbId', 'mac'],
+        decode=_decode_fdb),
+    'inetCidrRouteTable': TableSpec(
+        entry='1.3.6.1.2.1.4.24.7.1',
+        columns=[('inetCidrRouteIfIndex', 7),
+                 ('inetCidrRouteType', 8),
+                 ('inetCidrRouteProto', 9),
+                 ('inetCidrRouteMetric1', 12)],
+        keys=['destination', 'prefixLength', 'nextHop'],
+        decode=_decode_route),
+    }
+
+
+class TableStore:
+    '''
+    SQLite database holding harvested tables.
+    Each table gets a database table of the same name, with one row per SNMP row:
+    the dotted index, the values decoded from it, then the walked columns.
+    The 'harvests' table records when each table was harvested, and whether it's complete.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.conn = sqlite3.connect(filepath, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS harvests (
+                                 name TEXT PRIMARY KEY,
+                                 started REAL,
+                                 finished REAL,
+                                 rows INTEGER,
+                                 complete INTEGER,
+                                 reason TEXT)''')
+
+    @staticmethod
+    def _fields(spec):
+        'Names of the fields stored for a table, after the index.'
+        return spec.keys + [name for (name, _) in spec.columns]
+
+    @staticmethod
+    def _staging(name):
+        'Name of the staging table that a harvest of this table is written to.'
+        return '{}_staging'.format(name)
+
+    def reset(self, name, staging=False):
+        '''
+        Create, or empty, the database table for a harvest.
+        With 'staging', this is the table's staging table instead.
+        '''
+        spec = TABLES[name]
+        table = self._staging(name) if staging else name
+        self.conn.execute('CREATE TABLE IF NOT EXISTS "{}" (idx TEXT PRIMARY KEY, {})'.format(
+            table, ', '.join('"{}"'.format(field) for field in self._fields(spec))))
+        self.conn.execute('DELETE FROM "{}"'.format(table))
+        self.conn.commit()
+
+    def store_rows(self, name, rows, staging=False):
+        '''
+        Insert or update a batch of rows: a list of (index string, list of field values).
+        A value of None leaves any existing value in place, so that cells from
+        columns that arrive out of step with each other end up in the same row.
+        With 'staging', the rows go into the table's staging table.
+        '''
+        fields = self._fields(TABLES[name])
+        self.conn.executemany(
+            'INSERT INTO "{0}" (idx, {1}) VALUES (?, {2}) '
+            'ON CONFLICT(idx) DO UPDATE SET {3}'.format(
+                self._staging(name) if staging else name,
+                ', '.join('"{}"'.format(field) for field in fields),
+                ', '.join('?' for _ in fields),
+                ', '.join('"{0}" = COALESCE(excluded."{0}", "{0}")'.format(field)
+                          for field in fields)),
+            [[index] + values for (index, values) in rows])
+        self.conn.commit()
+
+    def swap_in(self, name):
+        'Replace the stored table with the contents of its staging table, in one transaction.'
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+            self.conn.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(self._staging(name), name))
+
+    def discard_staging(self, name):
+        'Drop the staging table for a table, leaving the stored table as it was.'
+        with self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS "{}"'.format(self._staging(name)))
+
+    def record_harvest(self, result, started):
+        'Record the outcome of a harvest.'
+        self.conn.execute('INSERT OR REPLACE INTO harvests VALUES (?, ?, ?, ?, ?, ?)',
+                          (result.table, started, started + result.elapsed, result.rows,
+                           int(result.complete), result.reason))
+        self.conn.commit()
+
+    def harvest_info(self, name):
+        'Return the HarvestResult recorded for a table, or None if it was never harvested.'
+        row = self.conn.execute('SELECT name, rows, complete, reason, finished - started '
+                                'FROM harvests WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        return HarvestResult(table=row[0], rows=row[1], complete=bool(row[2]), reason=row[3],
+                             elapsed=row[4])
+
+    def iter_rows(self, name):
+        '''
+        Iterate over the stored rows of a table, as namedtuples whose fields are 'index',
+        followed by the decoded index values and the walked columns.
+        Rows are read from the database as they're consumed, not loaded all at once.
+        '''
+        row_type = namedtuple(name, ['index'] + self._fields(TABLES[name]))
+        cursor = self.conn.execute('SELECT * FROM "{}" ORDER BY rowid'.format(name))
+        for row in cursor:
+            yield row_type(*row)
+
+    def count(self, name):
+        'Return the number of rows stored for a table.'
+        return self.conn.execute('SELECT COUNT(*) FROM "{}"'.format(name)).fetchone()[0]
+
+    def close(self):
+        'Close the database.'
+        self.conn.close()
+
+
+def harvest_table(device, name, store, max_rows=None, max_seconds=None, batch_size=1000,
+                  max_repetitions=25):
+    '''
+    Walk one of the tables in TABLES on a device, streaming its rows into a TableStore.
+    - device: a Mib2 (or subclass) object, whose SNMP session is reused.
+    - max_rows: stop after storing this many rows.
+    - max_seconds: stop after this long.
+    - batch_size: number of rows to write to the database per transaction.
+    Return a HarvestResult namedtuple.
+    The rows replace the stored table, and the result is recorded in the store, if the
+    harvest is complete or the store has no complete harvest of this table. Otherwise,
+    they're discarded, and the stored table and its recorded result are left as they were.
+    '''
+    spec = TABLES[name]
+    store.reset(name, staging=True)
+    started = time.time()
+    deadline = time.monotonic() + max_seconds if max_seconds is not None else None
+    (rows, complete, reason) = (0, True, None)
+    batch = {}      # Index string -> list of field values, for the rows not yet written
+    cells = snmp_walk_columns(device.engine,
+                              device.auth,
+                              device.target,
+                              ['{}.{}'.format(spec.entry, number) for (_, number) in spec.columns],
+                              device.logger,
+                              max_repetitions=max_repetitions,
+                              deadline=deadline)
+    try:
+        for cell in cells:
+            # Every row has a value in the first column, and each value arrives once,
+            # so counting those counts the rows without remembering every index.
+            if cell.column == 0:
+                if max_rows is not None and rows >= max_rows:
+                    (complete, reason) = (False, 'max_rows')
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    (complete, reason) = (False, 'max_seconds')
+                    break
+                rows += 1
+            index = '.'.join(str(arc) for arc in cell.oid)
+            if index not in batch:
+                try:
+                    keys = list(spec.decode(cell.oid))
+                except (IndexError, ValueError):
+                    keys = [None] * len(spec.keys)
+                batch[index] = keys + [None] * len(spec.columns)
+            batch[index][len(spec.keys) + cell.column] = cell.value
+            if len(batch) >= batch_size:
+                store.store_rows(name, list(batch.items()), staging=True)
+                batch = {}
+    except DeadlineExceeded:
+        (complete, reason) = (False, 'max_seconds')
+    except RuntimeError as err:
+        (complete, reason) = (False, str(err))
+    finally:
+        # Stop the walk, if we're ending early.
+        cells.close()
+    if batch:
+        store.store_rows(name, list(batch.items()), staging=True)
+    result = HarvestResult(table=name, rows=rows, complete=complete, reason=reason,
+                           elapsed=time.time() - started)
+    previous = store.harvest_info(name)
+    if not complete and previous is not None and previous.complete:
+        device.logger.warning('Harvest of %s from %s stopped early (%s); keeping the previous one',
+                              name, device.target.transportAddr[0], reason)
+        store.discard_staging(name)
+        return result
+    store.swap_in(name)
+    store.record_harvest(result, started)
+    device.logger.info('Harvested %s rows of %s from %s; complete: %s',
+                       rows, name, device.target.transportAddr[0], complete)
+    return result
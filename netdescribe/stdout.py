@@ -23,9 +23,12 @@ i.e. to the terminal/CLI unless redirected.
 from netdescribe.snmp import device_discovery
 from netdescribe.utils import create_logger
 
-def snmp_to_json(target, community, logger=None):
+def snmp_to_json(target, community, logger=None, profiler=None, budget=None, table_budget=None,
+                 window=None, credential_cache=None,
+                 discovery_profile=None):
     """
     Explore a device via SNMP, and return the results to STDOUT in JSON.
+    'community' may be a single community string, or a list of candidates.
     """
     # Ensure we have a logging object.
     # Normally I'd default the loglevel to INFO, but this function will be more
@@ -37,5 +40,9 @@ def snmp_to_json(target, community, logger=None):
         slogger = create_logger(loglevel="warn")
     # Perform SNMP discovery on a device and print the result to STDOUT.
     # Do basic pretty-printing of the output, for human-readability.
-    response = device_discovery.explore_device(target, slogger, community=community)
+    response = device_discovery.explore_device(target, slogger, community=community,
+                                               profiler=profiler, budget=budget,
+                                               table_budget=table_budget, window=window,
+                                               credential_cache=credential_cache,
+                                               discovery_profile=discovery_profile)
     print(response)